@@ -0,0 +1,53 @@
+-- lua/semshi/highlights.lua
+--
+-- Applies batches of highlights sent by the buffer handler (see
+-- rplugin/python3/semshi/handler.py) as extmarks, so a batch takes a single
+-- RPC call with a compact payload instead of one call per highlight.
+
+local api = vim.api
+
+local M = {}
+
+-- Add highlights to the buffer `buf` in the namespace named `ns`. `data` is a
+-- flat list of (id, group, line, col, end) items, where `group` is an index
+-- into `groups`. An ID of 0 lets Neovim choose the extmark ID.
+function M.add(buf, ns, groups, data)
+  if not api.nvim_buf_is_valid(buf) then
+    return
+  end
+  local ns_id = api.nvim_create_namespace(ns)
+  local set_extmark = api.nvim_buf_set_extmark
+  for i = 1, #data, 5 do
+    local opts = { end_col = data[i + 4], hl_group = groups[data[i + 1]] }
+    if data[i] > 0 then
+      opts.id = data[i]
+    end
+    -- The buffer may have changed since it was parsed, so the position can
+    -- be out of range.
+    pcall(set_extmark, buf, ns_id, data[i + 2], data[i + 3], opts)
+  end
+end
+
+-- Delete the highlights with the IDs `ids` in the namespace named `ns`.
+function M.del(buf, ns, ids)
+  if not api.nvim_buf_is_valid(buf) then
+    return
+  end
+  local ns_id = api.nvim_create_namespace(ns)
+  local del_extmark = api.nvim_buf_del_extmark
+  for _, id in ipairs(ids) do
+    del_extmark(buf, ns_id, id)
+  end
+end
+
+-- Clear all highlights in the namespace named `ns` from line `start` to
+-- `stop` (0-based, end-exclusive, -1 for the end of the buffer).
+function M.clear(buf, ns, start, stop)
+  if not api.nvim_buf_is_valid(buf) then
+    return
+  end
+  api.nvim_buf_clear_namespace(buf, api.nvim_create_namespace(ns), start or 0,
+                               stop or -1)
+end
+
+return M
@@ -94,15 +94,18 @@ function! semshi#buffer_attach()
     let b:semshi_attached = v:true
     augroup SemshiEvents
         autocmd! * <buffer>
-        autocmd BufEnter <buffer> call SemshiBufEnter(+expand('<abuf>'), line('w0'), line('w$'))
+        autocmd BufEnter <buffer> call SemshiBufEnter(+expand('<abuf>'), line('w0'), line('w$'), win_getid())
         autocmd BufLeave <buffer> call SemshiBufLeave()
-        autocmd VimResized <buffer> call SemshiVimResized(line('w0'), line('w$'))
+        autocmd VimResized <buffer> call SemshiVimResized(line('w0'), line('w$'), win_getid())
         autocmd TextChanged <buffer> call SemshiTextChanged()
         autocmd TextChangedI <buffer> call SemshiTextChanged()
-        autocmd CursorMoved <buffer> call SemshiCursorMoved(line('w0'), line('w$'))
-        autocmd CursorMovedI <buffer> call SemshiCursorMoved(line('w0'), line('w$'))
+        autocmd CursorMoved <buffer> call SemshiCursorMoved(line('w0'), line('w$'), line('.'), col('.') - 1, win_getid())
+        autocmd CursorMovedI <buffer> call SemshiCursorMoved(line('w0'), line('w$'), line('.'), col('.') - 1, win_getid())
+        if exists('##WinClosed')
+            autocmd WinClosed <buffer> call SemshiWinClosed(+expand('<amatch>'))
+        endif
     augroup END
-    call SemshiBufEnter(bufnr('%'), line('w0'), line('w$'))
+    call SemshiBufEnter(bufnr('%'), line('w0'), line('w$'), win_getid())
 endfunction
 
 function! semshi#buffer_detach()
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import sys
+
+from .util import logger
+
+# Number of entries the cache keeps at most
+MAX_ENTRIES = 1000
+
+
+class HighlightCache:
+    """On-disk cache of the nodes of files.
+
+    Every file has a single entry (named after the hash of its path) which
+    holds a compact node table. An entry is only valid for the same content
+    and Python version it was stored with. Beyond `max_entries` entries, the
+    least recently used ones are removed.
+    """
+
+    def __init__(self, directory, max_entries=MAX_ENTRIES):
+        self._directory = directory
+        self._max_entries = max_entries
+
+    def _entry_path(self, path):
+        digest = hashlib.sha1(path.encode('utf-8', 'surrogateescape'))
+        return os.path.join(self._directory, digest.hexdigest() + '.json')
+
+    @staticmethod
+    def _key(code):
+        """Return the key under which nodes of `code` are valid."""
+        digest = hashlib.sha1(code.encode('utf-8', 'surrogateescape'))
+        return '%d.%d:%s' % (*sys.version_info[:2], digest.hexdigest())
+
+    def has_entry(self, path):
+        """Return whether there is a cache entry for the file `path`, which
+        may not be valid for its current content."""
+        return os.path.isfile(self._entry_path(path))
+
+    def load(self, path, code):
+        """Return the cached nodes of the file `path` with the content `code`
+        as tuples (lineno, col, end, hl_group), or None if there is no valid
+        cache entry."""
+        entry_path = self._entry_path(path)
+        try:
+            with open(entry_path, encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        try:
+            if entry['path'] != path or entry['key'] != self._key(code):
+                return None
+            groups = entry['groups']
+            table = entry['nodes']
+            nodes = [(table[i], table[i + 1], table[i + 2],
+                      groups[table[i + 3]]) for i in range(0, len(table), 4)]
+        except (KeyError, IndexError, TypeError):
+            logger.debug('invalid cache entry for %s', path)
+            return None
+        try:
+            # Mark the entry as recently used (see _prune())
+            os.utime(entry_path)
+        except OSError:
+            pass
+        return nodes
+
+    def store(self, path, code, nodes):
+        """Store `nodes` as tuples (lineno, col, end, hl_group) as the nodes of
+        the file `path` with the content `code`."""
+        groups = {}
+        table = []
+        for lineno, col, end, hl_group in nodes:
+            group = groups.setdefault(hl_group, len(groups))
+            table += (lineno, col, end, group)
+        entry = {
+            'path': path,
+            'key': self._key(code),
+            'groups': list(groups),
+            'nodes': table,
+        }
+        entry_path = self._entry_path(path)
+        try:
+            os.makedirs(self._directory, exist_ok=True)
+            # Write to a temporary file first, so a concurrent load never
+            # reads a partial entry.
+            with open(entry_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(entry, f, separators=(',', ':'))
+            os.replace(entry_path + '.tmp', entry_path)
+        except OSError as e:
+            logger.debug('failed to store cache entry for %s: %s', path, e)
+            return
+        self._prune()
+
+    def _prune(self):
+        """Remove the least recently used entries beyond the maximum number of
+        entries."""
+        try:
+            entries = [
+                entry for entry in os.scandir(self._directory)
+                if entry.name.endswith('.json')
+            ]
+            excess = len(entries) - self._max_entries
+            if excess <= 0:
+                return
+            entries.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in entries[:excess]:
+                os.remove(entry.path)
+        except OSError as e:
+            logger.debug('failed to prune cache: %s', e)
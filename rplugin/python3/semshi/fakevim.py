@@ -0,0 +1,226 @@
+"""A stand-in for the parts of the pynvim API used by the buffer handler.
+
+It keeps track of the highlights of its buffers and counts all RPC calls and
+the size of their payloads, so the handler can be tested and benchmarked
+without Neovim (see script/replay.py). Calls of the Lua helper
+(lua/semshi/highlights.lua) are emulated.
+"""
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+
+import msgpack
+
+from .handler import BufferHandler
+from .plugin import Options
+
+# The fakes take the arguments of the pynvim API they stand in for
+# pylint: disable=unused-argument,too-many-positional-arguments
+
+
+class FakeBuffer:
+
+    def __init__(self, vim, number, lines, name=''):
+        self._vim = vim
+        self.number = number
+        self.name = name
+        self.lines = list(lines)
+        # Highlights by source ID, or by (namespace, ID) or namespace for
+        # extmarks, as sets of (hl_group, line, col, end)
+        self.highlights = defaultdict(set)
+        self.valid = True
+
+    def __getitem__(self, key):
+        return self.lines[key]
+
+    def __setitem__(self, key, value):
+        self.lines[key] = value
+
+    def __len__(self):
+        return len(self.lines)
+
+    def set_lines(self, start, end, lines):
+        """Replace the lines from `start` to `end` with `lines`, and move the
+        highlights like Neovim moves extmarks."""
+        self.lines[start:end] = lines
+        delta = len(lines) - (end - start)
+        for key, hls in self.highlights.items():
+            moved = set()
+            for group, line, col, col_end in hls:
+                if line >= end:
+                    line += delta
+                elif line >= start + len(lines):
+                    # Highlights in deleted lines collapse
+                    line, col, col_end = start + len(lines), 0, 0
+                moved.add((group, line, col, col_end))
+            self.highlights[key] = moved
+
+    def add_highlight(self,
+                      hl_group,
+                      line,
+                      col_start=0,
+                      col_end=-1,
+                      src_id=-1,
+                      async_=None):
+        self._vim.api.call_atomic([('nvim_buf_add_highlight',
+                                    (self, src_id, hl_group, line, col_start,
+                                     col_end))])
+
+    def clear_highlight(self, src_id, line_start=0, line_end=-1, async_=None):
+        self._vim.api.call_atomic([('nvim_buf_clear_highlight',
+                                    (self, src_id, line_start, line_end))])
+
+    def visible_highlights(self):
+        """Return all highlights as set of (hl_group, line, col, end)."""
+        return {
+            hl
+            for hl in set().union(*self.highlights.values()) if hl[2] < hl[3]
+        }
+
+
+class FakeWindow:
+
+    def __init__(self):
+        self.cursor = (1, 0)
+
+
+class FakeCurrent:
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.window = FakeWindow()
+
+
+class FakeApi:
+
+    def __init__(self, vim):
+        self._vim = vim
+
+    def buf_is_valid(self, buf):
+        return buf.valid
+
+    def out_write(self, s):
+        self._vim.output.append(s)
+
+    def call_atomic(self, calls, async_=None):
+        vim = self._vim
+        vim.stats['call_atomic'] += 1
+        vim.stats['calls'] += len(calls)
+        vim.stats['bytes'] += len(
+            msgpack.packb(calls, default=lambda buf: buf.number))
+        for name, args in calls:
+            getattr(self, '_' + name)(*args)
+        return [[None] * len(calls), None]
+
+    @staticmethod
+    def _nvim_buf_add_highlight(buf, src_id, hl_group, line, col, end):
+        buf.highlights[src_id].add((hl_group, line, col, end))
+
+    @staticmethod
+    def _nvim_buf_clear_highlight(buf, src_id, start, end):
+        if end == -1:
+            end = float('inf')
+        src_ids = list(buf.highlights) if src_id == -1 else [src_id]
+        for id in src_ids:
+            buf.highlights[id] = {
+                hl
+                for hl in buf.highlights[id] if not start <= hl[1] < end
+            }
+
+
+class FakeNvim:
+    """The fake Neovim instance.
+
+    `async_call()` runs the function right away, but like the Neovim event
+    loop, never runs two functions concurrently.
+    """
+
+    def __init__(self, lines=(), name='', variables=None):
+        self.vars = dict(variables or {})
+        self.api = FakeApi(self)
+        self.current = FakeCurrent(FakeBuffer(self, 1, lines, name))
+        self.stats = Counter()
+        self.commands = []
+        self.output = []
+        self._loop_lock = threading.RLock()
+
+    def async_call(self, func, *args, **kwargs):
+        self.stats['async_call'] += 1
+        with self._loop_lock:
+            func(*args, **kwargs)
+
+    def exec_lua(self, code, *args, async_=None):
+        self.stats['exec_lua'] += 1
+        self.stats['calls'] += 1
+        self.stats['bytes'] += len(
+            msgpack.packb([code, args], default=lambda buf: buf.number))
+        func = re.fullmatch(
+            r'require\("semshi\.highlights"\)\.(\w+)\(\.\.\.\)', code).group(1)
+        getattr(self, '_lua_' + func)(*args)
+
+    @staticmethod
+    def _lua_add(buf, ns, groups, data):
+        for i in range(0, len(data), 5):
+            id, group, line, col, end = data[i:i + 5]
+            hl = (groups[group - 1], line, col, end)
+            if id:
+                # Setting an extmark with an existing ID moves it
+                buf.highlights[(ns, id)] = {hl}
+            else:
+                buf.highlights[ns].add(hl)
+
+    @staticmethod
+    def _lua_del(buf, ns, ids):
+        for id in ids:
+            buf.highlights.pop((ns, id), None)
+
+    @staticmethod
+    def _lua_clear(buf, ns, start, end):
+        if end == -1:
+            end = float('inf')
+        for key in list(buf.highlights):
+            if key == ns or isinstance(key, tuple) and key[0] == ns:
+                buf.highlights[key] = {
+                    hl
+                    for hl in buf.highlights[key] if not start <= hl[1] < end
+                }
+
+    def command(self, cmd, async_=None):
+        self.stats['command'] += 1
+        self.commands.append(cmd)
+
+    def out_write(self, s):
+        self.output.append(s)
+
+
+def replay(buffer, events, variables=None):
+    """Replay `events` on a handler of a fake buffer and return tuple
+    (`vim`, `latencies`) where latencies maps event types to the seconds
+    every event took to process."""
+    vim = FakeNvim(buffer['lines'], buffer.get('name', ''), variables)
+    buf = vim.current.buffer
+    handler = BufferHandler(buf, vim, Options(vim))
+    latencies = defaultdict(list)
+    start = time.perf_counter()
+    handler.viewport(1, 50)
+    handler.update(force=True, sync=True)
+    latencies['enable'].append(time.perf_counter() - start)
+    for event in events:
+        type_ = event['event']
+        start = time.perf_counter()
+        if type_ == 'edit':
+            buf.set_lines(event['start'], event['end'], event['lines'])
+            handler.update(sync=True)
+        elif type_ == 'viewport':
+            handler.viewport(event['start'], event['stop'],
+                             event.get('window', 0))
+        elif type_ == 'remove_viewport':
+            handler.remove_viewport(event['window'])
+        elif type_ == 'cursor':
+            vim.current.window.cursor = tuple(event['cursor'])
+            handler.mark_selected(vim.current.window.cursor)
+        else:
+            raise ValueError('Unknown event: %s' % type_)
+        latencies[type_].append(time.perf_counter() - start)
+    return vim, latencies
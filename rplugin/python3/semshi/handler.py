@@ -1,8 +1,9 @@
 from __future__ import annotations
 
+import sys
 import threading
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
 from typing import Optional
 
 import pynvim
@@ -10,12 +11,34 @@ import pynvim.api
 from pynvim.api import Buffer, Nvim
 
 from . import plugin
+from .cache import HighlightCache
 from .node import SELECTED, Node, hl_groups
 from .parser import Parser, UnparsableError
-from .util import debug_time, lines_to_code, logger
+from .profiling import UpdateProfiler
+from .trace import TraceRecorder
+from .util import code_to_lines, lines_to_code, logger, merge_ranges, timed
 
 ERROR_SIGN_ID = 314000
 ERROR_HL_ID = 313000
+CACHE_HL_ID = 313100
+# Number of pending nodes to paint at once when painting progressively
+PAINT_BATCH_SIZE = 1000
+# Seconds to pause between two progressive batches
+PAINT_BATCH_DELAY = 0.01
+# Number of updates to keep statistics of
+UPDATE_STATS_SIZE = 10
+# Namespaces of the extmarks when highlighting with Lua (see
+# lua/semshi/highlights.lua). Highlights of nodes and marks of selected nodes
+# use their ID as extmark ID, highlights sharing an ID get a namespace of their
+# own.
+NODE_NAMESPACE = 'semshi'
+MARK_NAMESPACE = 'semshiSelected'
+LUA_NAMESPACES = {CACHE_HL_ID: 'semshiCache'}
+# Number of highlights to send with one call of the Lua helper
+LUA_BATCH_SIZE = 10000
+# Minimum number of highlights to clear to consider clearing all highlights
+# at once instead (see _should_reset_hls())
+RESET_MIN_CLEARS = 100
 
 
 class BufferHandler:
@@ -33,7 +56,26 @@ class BufferHandler:
         self._parser = Parser(options.excluded_hl_groups,
                               options.tolerate_syntax_errors)
         self._scheduled = False
+        # Whether the next update of the update thread is forced
+        self._force_scheduled = False
+        # Whether all pending nodes are to be painted after updating
+        self._paint_all = False
+        # Whether they are painted because the user is idle (see
+        # _paint_idle())
+        self._idle_painting = False
+        self._idle_timer = None
+        # The time of the last input (see _schedule_idle_paint())
+        self._last_input = 0
+        # Input is recorded by the main and the update thread
+        self._idle_timer_lock = threading.Lock()
         self._viewport_changed = False
+        # The visible lines and the lines to add the highlights of (see
+        # viewport()) of each window showing the buffer
+        self._viewports = {}
+        self._views = {}
+        # The views of all windows merged into sorted, disjoint line ranges
+        self._view_ranges = []
+        # The view of the window whose viewport was set last
         self._view = (0, 0)
         self._update_thread = None
         self._error_timer = None
@@ -44,6 +86,26 @@ class BufferHandler:
         # Nodes which are currently marked as a selected. We keep track of them
         # to check if they haven't changed between updates.
         self._selected_nodes = []
+        # IDs of the highlights which were painted before the parser state was
+        # evicted (see evict()), to be cleared with the next update
+        self._stale_ids = []
+        self._cache = None
+        if options.cache_dir:
+            self._cache = HighlightCache(options.cache_dir)
+        # The file path of the buffer if its nodes need to be cached
+        self._cache_path = None
+        # The code the current nodes were parsed from, if from the buffer
+        self._cache_code = None
+        # Whether highlights from the cache are currently displayed, or None
+        # once the buffer has been parsed (see _paint_cached())
+        self._cache_painted = False
+        self._cache_lock = threading.Lock()
+        self._cache_checked = False
+        # Statistics of the most recent updates (see _update_step())
+        self.update_stats = deque(maxlen=UPDATE_STATS_SIZE)
+        self._profiler = UpdateProfiler()
+        # Records the session if enabled (see trace.py)
+        self._trace = TraceRecorder.from_env(buf)
 
     def __repr__(self):
         return '<BufferHandler(%d)>' % self._buf_num
@@ -52,11 +114,40 @@ class BufferHandler:
         """A debugging utility to print something into neovim's stdout."""
         self._vim.async_call(self._vim.api.out_write, str(s) + '\n')
 
-    def viewport(self, start, stop):
-        """Set viewport to line range from `start` to `stop` and add highlights
-        that have become visible."""
-        range = stop - start
-        self._view = (start - range, stop + range)
+    def viewport(self, start, stop, window=0):
+        """Set viewport of the window with the ID `window` to line range from
+        `start` to `stop` and add highlights that have become visible.
+
+        Highlights are added in the view, which extends the viewport by the
+        lookahead in both directions. The view only moves once the viewport
+        comes closer to one of its edges than half the lookahead (or the
+        viewport shrinks). When scrolling, the view then extends twice the
+        lookahead in the direction of scrolling, so highlights are added in few
+        batches ahead of time.
+
+        Highlights are added in the views of all windows showing the buffer.
+        """
+        if self._trace is not None:
+            self._trace.viewport(start, stop, window)
+        self._schedule_idle_paint()
+        old_start = self._viewports.get(window, (0, 0))[0]
+        self._viewports[window] = (start, stop)
+        lookahead = int((stop - start) * self._options.viewport_lookahead)
+        view_start, view_stop = self._views.get(window, (0, 0))
+        if view_start <= start - lookahead // 2 and \
+                stop + lookahead // 2 <= view_stop and \
+                view_stop - view_start <= stop - start + 3 * lookahead:
+            self._view = (view_start, view_stop)
+            return
+        ahead = behind = lookahead
+        if start <= view_stop and stop >= view_start:
+            # Scrolling within the view
+            if start > old_start:
+                ahead *= 2
+            elif start < old_start:
+                behind *= 2
+        self._view = self._views[window] = (start - behind, stop + ahead)
+        self._view_ranges = merge_ranges(self._views.values())
         # If the update thread is running, we defer addding visible highlights
         # for the new viewport to after the update loop is done.
         if self._update_thread is not None and self._update_thread.is_alive():
@@ -64,15 +155,43 @@ class BufferHandler:
             return
         self._add_visible_hls()
 
-    def update(self, force=False, sync=False):
+    def remove_viewport(self, window):
+        """Stop adding highlights in the view of the window with the ID
+        `window`, which doesn't show the buffer anymore. Its highlights are
+        kept."""
+        if self._views.pop(window, None) is None:
+            return
+        if self._trace is not None:
+            self._trace.remove_viewport(window)
+        del self._viewports[window]
+        self._view_ranges = merge_ranges(self._views.values())
+
+    def update(self, force=False, sync=False, progressive=False):
         """Update.
 
         If `sync`, trigger update immediately, otherwise start thread to update
-        code if thread isn't running already.
+        code if thread isn't running already. The first update doesn't block
+        if highlights could be painted from the cache.
+
+        If `progressive`, the update doesn't block, and once the highlights in
+        the viewport have been added, all remaining highlights are added in
+        batches.
         """
+        if self._parser.tick == 0 and not self._cache_checked:
+            self._cache_checked = True
+            if self._load_cache():
+                sync = False
+        self._schedule_idle_paint()
+        if self._idle_painting:
+            # Painting continues once the user is idle again
+            self._paint_all = self._idle_painting = False
+        if progressive:
+            sync = False
+            self._paint_all = True
         if sync:
-            self._update_step(force=force, sync=True)
+            self._run_update_step(force=force, sync=True)
             return
+        self._force_scheduled |= force
         thread = self._update_thread
         # If there is an active update thread...
         if thread is not None and thread.is_alive():
@@ -84,29 +203,103 @@ class BufferHandler:
         self._update_thread = thread
         thread.start()
 
+    def _load_cache(self):
+        """Start loading the cached highlights of the buffer in the
+        background, to paint them until the buffer has been parsed. Return
+        True if there is a cache entry for the buffer."""
+        if self._cache is None:
+            return False
+        path = self._buf.name
+        if not path:
+            return False
+        if not self._cache.has_entry(path):
+            # Cache the nodes once the buffer has been parsed
+            self._cache_path = path
+            return False
+        threading.Thread(target=self._load_cache_entry,
+                         args=(path, self._buf[:]),
+                         daemon=True).start()
+        return True
+
+    def _load_cache_entry(self, path, lines):
+        nodes = self._cache.load(path, lines_to_code(lines))
+        if nodes is None:
+            # The file changed, so cache the nodes once it has been parsed
+            self._cache_path = path
+            return
+        self._vim.async_call(self._paint_cached, nodes)
+
+    def _paint_cached(self, nodes):
+        """Paint the cached `nodes` in the view, unless the buffer has been
+        parsed in the meantime."""
+        excluded = self._options.excluded_hl_groups
+        with self._cache_lock:
+            if self._cache_painted is None:
+                return
+            self._add_hls([(CACHE_HL_ID, group, lineno - 1, col, end)
+                           for lineno, col, end, group in nodes
+                           if self._in_view(lineno) and group not in excluded])
+            self._cache_painted = True
+
+    def _clear_cached_hls(self):
+        """Clear the highlights painted from the cache, which the parsed
+        highlights replace, and don't paint them anymore."""
+        with self._cache_lock:
+            cache_painted, self._cache_painted = self._cache_painted, None
+        if cache_painted:
+            self._clear_hls((CACHE_HL_ID, 0, -1))
+
+    def _store_cache(self):
+        """Store the current nodes of the buffer in the cache if they need to
+        be cached, once they have all been classified.
+
+        The nodes are stored in the background, but only classified nodes are
+        read, so lazy nodes aren't classified outside of the update thread.
+        """
+        if self._cache_path is None or self._cache_code is None:
+            return
+        nodes = self._parser._nodes  # pylint: disable=protected-access
+        if any(node.lazy for node in nodes):
+            return
+        path = self._cache_path
+        self._cache_path = None
+        nodes = [(n.lineno, n.col, n.end, n.hl_group) for n in nodes]
+        threading.Thread(target=self._cache.store,
+                         args=(path, self._cache_code, nodes),
+                         daemon=True).start()
+
     def clear_highlights(self):
         """Clear all highlights."""
         self._update_step(force=True, sync=True, code='')
 
-    @debug_time
+    @timed
     def mark_selected(self, cursor):
         """Mark all selected nodes.
 
         Selected nodes are those with the same name and scope as the one at the
         cursor position.
         """
+        if self._trace is not None:
+            self._trace.cursor(cursor)
+        self._schedule_idle_paint()
         if not self._options.mark_selected_nodes:
             return
         mark_original = bool(self._options.mark_selected_nodes - 1)
         nodes = self._parser.same_nodes(cursor, mark_original,
                                         self._options.self_to_attribute)
-        start, stop = self._view
-        nodes = [n for n in nodes if start <= n.lineno <= stop]
+        nodes, _ = self._visible_and_hidden(nodes)
         if nodes == self._selected_nodes:
             return
+        # Only update the marks of nodes that were (de)selected. Nodes keep
+        # their ID as long as they don't change, and their marks move with
+        # the lines like their highlights.
+        old_ids = {n.id for n in self._selected_nodes}
+        new_ids = {n.id for n in nodes}
+        deselected = [n for n in self._selected_nodes if n.id not in new_ids]
+        selected = [n for n in nodes if n.id not in old_ids]
         self._selected_nodes = nodes
-        self._clear_hls(nodes_to_hl(nodes, clear=True, marked=True))
-        self._add_hls(nodes_to_hl(nodes, marked=True))
+        self._clear_hls(nodes_to_hl(deselected, clear=True, marked=True))
+        self._add_hls(nodes_to_hl(selected, marked=True))
 
     def _wait_for(self, func, sync=False):
         """Return `func()`. If not `sync`, run `func` in async context and
@@ -141,84 +334,368 @@ class BufferHandler:
 
         return wrapper
 
-    def _update_loop(self):
+    def _update_loop(self, update=True):
+        """Update until no more updates are scheduled. If not `update`, start
+        with painting the pending nodes instead."""
         try:
             while True:
-                delay_factor = self._options.update_delay_factor
-                if delay_factor > 0:
-                    time.sleep(delay_factor * len(self._parser.lines))
-                self._update_step(self._options.always_update_all_highlights)
-                if not self._scheduled:
+                if update:
+                    delay_factor = self._options.update_delay_factor
+                    if delay_factor > 0:
+                        time.sleep(delay_factor * len(self._parser.lines))
+                    force = self._force_scheduled
+                    self._force_scheduled = False
+                    self._run_update_step(
+                        force or self._options.always_update_all_highlights)
+                if self._viewport_changed:
+                    self._viewport_changed = False
+                    self._add_visible_hls()
+                if not self._scheduled and self._paint_all:
+                    self._paint_pending()
+                if self._scheduled:
+                    self._scheduled = False
+                    update = True
+                elif self._viewport_changed:
+                    # Painting stopped to add the visible highlights first
+                    update = False
+                else:
                     break
-                self._scheduled = False
-            if self._viewport_changed:
-                self._add_visible_hls()
-                self._viewport_changed = False
+            self._schedule_idle_paint()
         except Exception:
             import traceback  # pylint: disable=import-outside-toplevel
             logger.error('Exception: %s', traceback.format_exc())
             raise
 
-    @debug_time
+    def start_profile(self, memory=False):
+        """Profile all following updates (see `UpdateProfiler.start()`)."""
+        return self._profiler.start(memory)
+
+    def stop_profile(self, path):
+        """Stop profiling and write the profile to `path` (see
+        `UpdateProfiler.stop()`)."""
+        return self._profiler.stop(path)
+
+    def _run_update_step(self, *args, **kwargs):
+        """Run `_update_step()`, profiled if profiling is active."""
+        self._profiler.run(self._update_step, *args, **kwargs)
+
+    @timed
     def _update_step(self, force=False, sync=False, code=None):
         """Trigger parser, update highlights accordingly, and trigger update of
         error sign.
         """
-        if code is None:
+        start = time.perf_counter()
+        timings = {}
+        from_buffer = code is None
+        if from_buffer:
             code = self._wait_for(lambda: lines_to_code(self._buf[:]), sync)
+            timings['fetch'] = time.perf_counter() - start
+            if self._trace is not None:
+                self._trace.lines(code_to_lines(code))
+        stats = {'time': time.time(), 'error': False, 'add': 0, 'rem': 0}
         try:
-            add, rem = self._parser.parse(code, force)
+            add, rem = self._parser.parse(code, force, self._view)
         except UnparsableError:
-            pass
+            stats['error'] = True
         else:
+            stats['add'] = len(add)
+            stats['rem'] = len(rem)
+            highlight_start = time.perf_counter()
+            if self._cache_painted is not None:
+                self._clear_cached_hls()
+            if self._stale_ids:
+                self._clear_hls([(id, 0, -1) for id in self._stale_ids])
+                self._stale_ids = []
             # TODO If we force update, can't we just clear all pending?
             # Remove nodes to be cleared from pending list
-            rem_remaining = debug_time('remove from pending')(
-                lambda: list(self._remove_from_pending(rem)))()
+            rem_remaining = self._remove_from_pending(rem)
+            if self._parser.line_shift is not None:
+                self._shift_pending()
             add_visible, add_hidden = self._visible_and_hidden(add)
-            # Add all new but hidden nodes to pending list
-            self._pending_nodes += add_hidden
-            # Update highlights by adding all new visible nodes and removing
-            # all old nodes which have been drawn earlier
-            self._update_hls(add_visible, rem_remaining)
+            if self._should_reset_hls(rem_remaining, add_visible):
+                self._reset_hls()
+            else:
+                # Add all new but hidden nodes to pending list
+                self._pending_nodes += add_hidden
+                # Update highlights by adding all new visible nodes and
+                # removing all old nodes which have been drawn earlier
+                self._update_hls(add_visible, rem_remaining)
             self.mark_selected(
                 self._wait_for(lambda: self._vim.current.window.cursor, sync))
+            timings['highlight'] = time.perf_counter() - highlight_start
+            pending_start = time.perf_counter()
+            self._visit_pending()
+            self._release_symtables()
+            timings['pending'] = time.perf_counter() - pending_start
+            self._cache_code = code if from_buffer else None
+            self._store_cache()
         if self._options.error_sign:
             self._schedule_update_error_sign()
-
-    @debug_time
+        timings.update(self._parser.timings)
+        timings['total'] = time.perf_counter() - start
+        stats['timings'] = timings
+        # pylint: disable=protected-access
+        stats['nodes'] = len(self._parser._nodes)
+        stats['pending'] = len(self._pending_nodes)
+        self.update_stats.append(stats)
+
+    @timed
+    def _visit_pending(self):
+        """Add the nodes of the parts of the code which the parser skipped
+        because they were outside of the viewport."""
+        while True:
+            add = self._parser.visit_pending()
+            if add is None:
+                break
+            add_visible, add_hidden = self._visible_and_hidden(add)
+            self._pending_nodes += add_hidden
+            self._add_hls(nodes_to_hl(self._without_excluded(add_visible)))
+            # Give other threads a chance to run between chunks
+            time.sleep(0)
+
+    @timed
+    def _release_symtables(self):
+        """Release the symtables of the nodes which don't need them anymore
+        because they have been classified (see
+        `Parser.releasable_nodes()`)."""
+        nodes = self._parser.releasable_nodes()
+        if nodes:
+            # Nodes may be classified in the main thread concurrently, so
+            # release the symtables there.
+            self._vim.async_call(Parser.release_symtables, nodes)
+
+    @timed
     def _add_visible_hls(self):
         """Add highlights in the current viewport which have not been applied
         yet."""
         visible, hidden = self._visible_and_hidden(self._pending_nodes)
-        self._add_hls(nodes_to_hl(visible))
+        self._add_hls(nodes_to_hl(self._without_excluded(visible)))
         self._pending_nodes = hidden
+        # Painting classified the visible lazy nodes
+        self._release_symtables()
+
+    def _paint_pending(self):
+        """Add the highlights of all pending nodes in batches, nearest to the
+        viewport first.
+
+        Stops early if another update has been scheduled or the viewport
+        changed in the meantime, in which case painting continues after that.
+        """
+        start, stop = self._view
+        center = (start + stop) // 2
+        nodes = sorted(self._pending_nodes,
+                       key=lambda n: abs(n.lineno - center))
+        painted = 0
+        while painted < len(nodes):
+            if self._scheduled or self._viewport_changed:
+                break
+            batch = nodes[painted:painted + PAINT_BATCH_SIZE]
+            self._add_hls(nodes_to_hl(self._without_excluded(batch)))
+            painted += len(batch)
+            time.sleep(PAINT_BATCH_DELAY)
+        else:
+            self._paint_all = self._idle_painting = False
+        painted_ids = {n.id for n in nodes[:painted]}
+        self._pending_nodes = [
+            n for n in self._pending_nodes if n.id not in painted_ids
+        ]
+        self._release_symtables()
+        # Painting classified the pending nodes
+        self._store_cache()
+
+    def _schedule_idle_paint(self):
+        """Paint all pending nodes once the user has been idle for the idle
+        paint delay.
+
+        This is called on every input, so it only records the time of the
+        input. A single timer checks it (see `_check_idle()`).
+        """
+        delay = self._options.idle_paint_delay
+        if delay <= 0:
+            return
+        with self._idle_timer_lock:
+            self._last_input = time.monotonic()
+            if self._idle_timer is None and self._pending_nodes:
+                self._start_idle_timer(delay)
+
+    def _start_idle_timer(self, delay):
+        timer = threading.Timer(delay, self._check_idle)
+        timer.daemon = True
+        self._idle_timer = timer
+        timer.start()
+
+    def _check_idle(self):
+        """Paint the pending nodes if the user has been idle for the idle
+        paint delay, otherwise check again once the delay will have passed
+        since the last input."""
+        with self._idle_timer_lock:
+            self._idle_timer = None
+            if not self._pending_nodes:
+                return
+            remaining = self._last_input + self._options.idle_paint_delay - \
+                time.monotonic()
+            if remaining > 0:
+                self._start_idle_timer(remaining)
+                return
+        self._vim.async_call(self._paint_idle)
+
+    def _paint_idle(self):
+        """Paint all pending nodes in the update thread, so scrolling to them
+        later doesn't need to add their highlights.
+
+        Any update stops painting until the user is idle again.
+        """
+        if self._paint_all or not self._pending_nodes:
+            return
+        self._paint_all = self._idle_painting = True
+        thread = self._update_thread
+        # A running update thread paints once it's done updating
+        if thread is not None and thread.is_alive():
+            return
+        thread = threading.Thread(target=self._update_loop, args=(False, ))
+        self._update_thread = thread
+        thread.start()
+
+    def _should_reset_hls(self, clear, add):
+        """Return whether clearing all highlights and adding the visible ones
+        again takes less highlights to send than clearing the highlights of
+        the nodes `clear` and adding those of `add`.
+
+        Only extmarks can be cleared at once, so this requires
+        `lua_highlights`.
+        """
+        if not self._options.lua_highlights or len(clear) < RESET_MIN_CLEARS:
+            return False
+        # pylint: disable=protected-access
+        visible = sum(self._in_view(n.lineno) for n in self._parser._nodes)
+        return len(clear) + len(add) > visible + 1
+
+    @timed
+    def _reset_hls(self):
+        """Clear the highlights of all nodes at once, add those of the visible
+        nodes again and add all other nodes to the pending list."""
+        self._exec_lua_async('clear', NODE_NAMESPACE, 0, -1)
+        self._stale_ids = []
+        excluded = self._options.excluded_hl_groups
+        # pylint: disable=protected-access
+        nodes = [
+            n for n in self._parser._nodes
+            if n.lazy or n.hl_group not in excluded
+        ]
+        visible, self._pending_nodes = self._visible_and_hidden(nodes)
+        self._add_hls(nodes_to_hl(self._without_excluded(visible)))
+
+    def _shift_pending(self):
+        """Replace the pending nodes with the nodes which adopted their IDs
+        after the parser matched them with the nodes of shifted lines.
+
+        The highlights of shifted nodes move with the lines in the buffer, but
+        the pending nodes would be added at their old lines.
+        """
+        # pylint: disable=protected-access
+        nodes_by_id = {n.id: n for n in self._parser._nodes}
+        self._pending_nodes = [
+            nodes_by_id[n.id] for n in self._pending_nodes
+            if n.id in nodes_by_id
+        ]
+
+    def _without_excluded(self, nodes):
+        """Return `nodes` without those of excluded highlight groups.
+
+        The parser can only filter nodes once they are classified, so lazy
+        nodes need to be filtered before they are displayed.
+        """
+        excluded = self._options.excluded_hl_groups
+        return [n for n in nodes if n.hl_group not in excluded]
+
+    def _in_view(self, lineno):
+        """Return whether the line `lineno` is in the view of any window."""
+        return any(start <= lineno <= end for start, end in self._view_ranges)
 
     def _visible_and_hidden(self, nodes):
         """Bisect nodes into visible and hidden ones."""
-        start, end = self._view
+        ranges = self._view_ranges
         visible = []
         hidden = []
         for node in nodes:
-            if start <= node.lineno <= end:
-                visible.append(node)
+            lineno = node.lineno
+            for start, end in ranges:
+                if start <= lineno <= end:
+                    visible.append(node)
+                    break
             else:
                 hidden.append(node)
         return visible, hidden
 
-    # pylint: disable=protected-access
-    @debug_time(None, lambda s, n: '%d / %d' % (len(n), len(s._pending_nodes)))
+    @timed
     def _remove_from_pending(self, nodes):
-        """Return nodes which couldn't be removed from the pending list (which
-        means they need to be cleared from the buffer).
+        """Remove `nodes` from the pending list and return those which
+        couldn't be removed (which means they need to be cleared from the
+        buffer).
         """
+        pending_ids = {node.id for node in self._pending_nodes}
+        removed_ids = set()
+        remaining = []
         for node in nodes:
-            try:
-                self._pending_nodes.remove(node)
-            except ValueError:
+            if node.id in pending_ids:
+                removed_ids.add(node.id)
+            else:
                 # TODO Can we maintain a list of nodes that should be active
                 # instead of creating it here?
-                yield node
+                remaining.append(node)
+        if removed_ids:
+            self._pending_nodes = [
+                n for n in self._pending_nodes if n.id not in removed_ids
+            ]
+        return remaining
+
+    def memory_usage(self):
+        """Return an estimate of the bytes retained by the handler as dict
+        with the keys of `Parser.memory_usage()`, "pending" and "total"."""
+        usage = self._parser.memory_usage()
+        usage['pending'] = sum(
+            sys.getsizeof(nodes)
+            for nodes in (self._pending_nodes, self._selected_nodes,
+                          self._stale_ids))
+        usage['pending'] += len(self._stale_ids) * sys.getsizeof(CACHE_HL_ID)
+        usage['total'] = sum(usage.values())
+        return usage
+
+    @property
+    def warm(self):
+        """Whether the handler holds the parser state of the buffer."""
+        return bool(self._parser.lines)
+
+    def evict(self):
+        """Drop the parser state to free memory. Return False if there was
+        nothing to drop or an update is running.
+
+        The highlights stay in place until the next update, which rebuilds
+        the state and replaces them.
+        """
+        thread = self._update_thread
+        if thread is not None and thread.is_alive():
+            return False
+        if not self.warm:
+            return False
+        parser = self._parser
+        # Lazy nodes are classified once they are painted, so those still
+        # lazy haven't been painted.
+        excluded = self._options.excluded_hl_groups
+        pending_ids = {n.id for n in self._pending_nodes}
+        # pylint: disable=protected-access
+        self._stale_ids += [
+            n.id for n in parser._nodes if n.id not in pending_ids
+            and not n.lazy and n.hl_group not in excluded
+        ]
+        self._clear_hls(
+            nodes_to_hl(self._selected_nodes, clear=True, marked=True))
+        self._parser = Parser(self._options.excluded_hl_groups,
+                              self._options.tolerate_syntax_errors)
+        self._pending_nodes = []
+        self._selected_nodes = []
+        self._paint_all = False
+        return True
 
     def _schedule_update_error_sign(self):
         if self._error_timer is not None:
@@ -269,12 +746,12 @@ class BufferHandler:
         command = self._wrap_async(self._vim.command)
         command('sign unplace %d buffer=%d' % (id, self._buf_num), async_=True)
 
-    @debug_time(None, lambda _, a, c: '+%d, -%d' % (len(a), len(c)))
+    @timed
     def _update_hls(self, add, clear):
-        self._add_hls(nodes_to_hl(add))
+        self._add_hls(nodes_to_hl(self._without_excluded(add)))
         self._clear_hls(nodes_to_hl(clear, clear=True))
 
-    @debug_time(None, lambda _, nodes: '%d nodes' % len(nodes))
+    @timed
     def _add_hls(self, node_or_nodes):
         buf = self._buf
         if not node_or_nodes:
@@ -282,14 +759,20 @@ class BufferHandler:
         if not isinstance(node_or_nodes, list):
             buf.add_highlight(*node_or_nodes)
             return
+        if self._options.lua_highlights:
+            self._add_hls_lua(node_or_nodes)
+            return
         self._call_atomic_async([('nvim_buf_add_highlight', (buf, *n))
                                  for n in node_or_nodes])
 
-    @debug_time(None, lambda _, nodes: '%d nodes' % len(nodes))
+    @timed
     def _clear_hls(self, node_or_nodes):
         buf = self._buf
         if not node_or_nodes:
             return
+        if self._options.lua_highlights:
+            self._clear_hls_lua(node_or_nodes)
+            return
         if not isinstance(node_or_nodes, list):
             self._wrap_async(buf.clear_highlight)(*node_or_nodes)
             return
@@ -298,6 +781,49 @@ class BufferHandler:
         self._call_atomic_async([('nvim_buf_clear_highlight', (buf, *n))
                                  for n in node_or_nodes])
 
+    def _add_hls_lua(self, hls):
+        """Add the highlights `hls` as extmarks with the Lua helper.
+
+        The highlights are sent as flat list of integers, with the highlight
+        groups replaced by their index in a list of the groups. All highlights
+        must share the namespace of the ID of the first one.
+        """
+        shared = hls[0][0] in LUA_NAMESPACES
+        groups = {}
+        data = []
+        for id, group, line, col, end in hls:
+            try:
+                idx = groups[group]
+            except KeyError:
+                # Lua lists are 1-based
+                idx = groups[group] = len(groups) + 1
+            data += (0 if shared else id, idx, line, col, end)
+        groups = list(groups)
+        step = LUA_BATCH_SIZE * 5
+        for i in range(0, len(data), step):
+            self._exec_lua_async('add', lua_namespace(hls[0][0]), groups,
+                                 data[i:i + step])
+
+    def _clear_hls_lua(self, node_or_nodes):
+        """Clear highlights like `_clear_hls()`, but with the Lua helper."""
+        if not isinstance(node_or_nodes, list):
+            id, start, stop = node_or_nodes
+            self._exec_lua_async('clear', lua_namespace(id), start, stop)
+            return
+        ids = [n[0] for n in node_or_nodes]
+        for i in range(0, len(ids), LUA_BATCH_SIZE):
+            self._exec_lua_async('del', lua_namespace(ids[0]),
+                                 ids[i:i + LUA_BATCH_SIZE])
+
+    def _exec_lua_async(self, func, *args):
+        """Call the function `func` of the Lua helper with the buffer and
+        `args` as arguments."""
+        code = 'require("semshi.highlights").%s(...)' % func
+        self._wrap_async(self._vim.exec_lua)(code,
+                                             self._buf,
+                                             *args,
+                                             async_=True)
+
     def _call_atomic_async(self, calls):
         # Need to update in small batches to avoid
         # https://github.com/neovim/python-client/issues/310
@@ -421,24 +947,37 @@ class BufferHandler:
                             (error.msg, error.lineno, error.offset))
 
     def shutdown(self):
-        # Cancel the error timer so vim quits immediately
+        # Cancel the timers so vim quits immediately
         if self._error_timer is not None:
             self._error_timer.cancel()
+        with self._idle_timer_lock:
+            if self._idle_timer is not None:
+                self._idle_timer.cancel()
+        if self._trace is not None:
+            self._trace.close()
 
 
 def nodes_to_hl(nodes, clear=False, marked=False):
     """Convert list of nodes to highlight tuples which are the arguments to
     neovim's add_highlight/clear_highlight APIs."""
     if clear:
-        if marked:
-            return (Node.MARK_ID, 0, -1)
-        return [(n.id, 0, -1) for n in nodes]
+        offset = Node.MARK_ID_OFFSET if marked else 0
+        return [(n.id + offset, 0, -1) for n in nodes]
     if marked:
-        id = Node.MARK_ID
-        return [(id, SELECTED, n.lineno - 1, n.col, n.end) for n in nodes]
+        offset = Node.MARK_ID_OFFSET
+        return [(n.id + offset, SELECTED, n.lineno - 1, n.col, n.end)
+                for n in nodes]
     return [(n.id, n.hl_group, n.lineno - 1, n.col, n.end) for n in nodes]
 
 
+def lua_namespace(id):
+    """Return the namespace of the extmarks of highlights with the ID `id`
+    when highlighting with Lua."""
+    if id in LUA_NAMESPACES:
+        return LUA_NAMESPACES[id]
+    return MARK_NAMESPACE if id >= Node.MARK_ID_OFFSET else NODE_NAMESPACE
+
+
 def next_location(here, locs, reverse=False):
     """Return the location of `locs` that comes after `here`."""
     locs = locs[:]
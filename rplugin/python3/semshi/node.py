@@ -28,21 +28,74 @@ more_builtins = {'__file__', '__path__', '__cached__'}
 builtins = set(vars(builtins)) | more_builtins
 
 
+class Scope:
+    """A lexical scope, linked to its enclosing scope.
+
+    Scopes form an immutable chain from the innermost to the module scope, so
+    all nodes of the same scope can share a single object.
+
+    The `key` identifies the scope by the names and positions of the
+    symtables of the chain, so the scopes of the same code are equal across
+    parses. (Symtables only know their line, so scopes sharing a line, such
+    as two lambdas, are told apart by the number the visitor gave them.)
+    Once all nodes of a parse are classified, the symtables are released (see
+    `release()`), and only the key is kept.
+    """
+    __slots__ = ['table', 'parent', 'root', 'key']
+
+    def __init__(self, table, parent=None):
+        self.table = table
+        self.parent = parent
+        self.root = self if parent is None else parent.root
+        key = (table.get_name(), table.get_lineno(),
+               getattr(table, 'sibling_idx', 0))
+        self.key = (key, ) if parent is None else parent.key + (key, )
+
+    def release(self):
+        """Drop the references to the symtables of the chain."""
+        scope = self
+        while scope is not None and scope.table is not None:
+            scope.table = None
+            scope = scope.parent
+
+    def __iter__(self):
+        """Iterate through the symtables from the outermost scope inwards."""
+        tables = list(reversed(self))
+        tables.reverse()
+        return iter(tables)
+
+    def __reversed__(self):
+        """Iterate through the symtables from the innermost scope outwards."""
+        scope = self
+        while scope is not None:
+            yield scope.table
+            scope = scope.parent
+
+
 class Node:
     """A node in the source code.
 
     """
-    # Highlight ID for selected nodes
-    MARK_ID = 31400
+    # Offset of the highlight IDs of selected nodes to the IDs of the nodes,
+    # so the mark of each node can be cleared on its own
+    MARK_ID_OFFSET = 1 << 30
     # Highlight ID counter (chosen arbitrarily)
     id_counter = count(314001)
 
     __slots__ = [
-        'id', 'name', 'lineno', 'col', 'end', 'env', 'symname', 'symbol',
-        'hl_group', 'target', '_tup'
+        'id', 'name', 'lineno', 'col', 'end', 'env', 'symname', 'hl_group',
+        'base_scope', 'target', '_tup', 'lazy'
     ]
 
-    def __init__(self, name, lineno, col, env, target=None, hl_group=None):
+    def __init__(self,
+                 name,
+                 lineno,
+                 col,
+                 env,
+                 *,
+                 target=None,
+                 hl_group=None,
+                 lazy=False):
         self.id = next(Node.id_counter)
         self.name = name
         self.lineno = lineno
@@ -53,20 +106,45 @@ class Node:
         self.symname = self._make_symname(name)
         # The target node for an attribute
         self.target = target
-
+        # With `lazy`, the highlight group and base scope are only determined
+        # when they are accessed for the first time (see __getattr__()).
+        self.lazy = lazy and hl_group is None
+        if not self.lazy:
+            self._classify(hl_group)
+
+    def __getattr__(self, name):
+        # Only called if a slot hasn't been set, which is the case for the
+        # highlight group and base scope of a lazy node.
+        if not self.lazy or name not in ('hl_group', 'base_scope', '_tup'):
+            raise AttributeError(name)
+        self._classify(None)
+        return getattr(self, name)
+
+    def _classify(self, hl_group):
+        """Look up the symbol and determine the highlight group (unless
+        `hl_group` is given) and the base scope.
+
+        The symbol isn't kept, so the node doesn't need the symtables
+        afterwards.
+        """
         if hl_group == ATTRIBUTE:
-            self.symbol = None
+            symbol = None
         else:
-            self.symbol = self._lookup_symbol(self.env, self.symname)
+            symbol = self._lookup_symbol(self.env, self.symname)
 
         if hl_group is None:
-            hl_group = self._make_hl_group()
+            hl_group = self._make_hl_group(symbol)
 
         self.hl_group = hl_group
+        self.base_scope = self._make_base_scope(symbol)
         self.update_tup()
+        self.lazy = False
 
     def update_tup(self):
         """Update tuple used for comparing with other nodes."""
+        # Not set in __init__(), so it stays unset until a lazy node is
+        # classified (see __getattr__())
+        # pylint: disable=attribute-defined-outside-init
         self._tup = (self.lineno, self.col, self.hl_group, self.name)
 
     def __lt__(self, other):
@@ -83,7 +161,7 @@ class Node:
         return '<%s %s %s (%s, %s) %d>' % (
             self.name,
             self.hl_group[6:],
-            '.'.join([x.get_name() for x in self.env]),
+            '.'.join([key[0] for key in self.env.key]),
             self.lineno,
             self.col,
             self.id,
@@ -93,18 +171,19 @@ class Node:
     def _lookup_symbol(env, symname):
         # Lookup a symbol in the current context,
         # from possibly nested symbol tables.
-        for table in reversed(env):
+        scope = env
+        while scope is not None:
             try:
-                return table.lookup(symname)
+                return scope.table.lookup(symname)
             except KeyError:
-                pass  # move up to the parent scope/symtable
+                scope = scope.parent  # move up to the parent scope/symtable
 
         # no matching symbol found
         return None
 
-    def _make_hl_group(self):
-        """Return highlight group the node belongs to."""
-        sym = self.symbol
+    def _make_hl_group(self, sym):
+        """Return highlight group the node with the symbol `sym` belongs
+        to."""
         name = self.name
 
         if sym is None:
@@ -117,7 +196,7 @@ class Node:
                 return UNRESOLVED
 
         if sym.is_parameter():
-            table = self.env[-1]
+            table = self.env.table
             # We have seen the node, so remove from unused parameters
             table.unused_params.pop(self.name, None)
             try:
@@ -139,7 +218,7 @@ class Node:
             return LOCAL
         if sym.is_global():
             try:
-                global_sym = self.env[0].lookup(name)
+                global_sym = self.env.root.table.lookup(name)
             except KeyError:
                 pass
             else:
@@ -182,30 +261,33 @@ class Node:
                 return table
         return None
 
-    def base_table(self):
-        """Return base symtable.
+    def _make_base_scope(self, symbol):
+        """Return the key of the base scope.
 
-        The base symtable is the lowest scope with an associated symbol.
+        The base scope is the lowest scope with an associated symbol.
         """
         if self.hl_group == ATTRIBUTE:
-            return self.env[-1]
+            return self.env.key
 
-        if self.symbol:
-            if self.symbol.is_global():
-                return self.env[0]
-            if self.symbol.is_local() and not self.symbol.is_free():
-                return self.env[-1]
+        if symbol:
+            if symbol.is_global():
+                return self.env.root.key
+            if symbol.is_local() and not symbol.is_free():
+                return self.env.key
 
-        for table in reversed(self.env):
+        scope = self.env
+        while scope is not None:
+            table = scope.table
             # Class scopes don't extend to enclosed scopes
-            if table.get_type() == 'class':
-                continue
-            try:
-                symbol = table.lookup(self.name)
-            except KeyError:
-                continue
-            if symbol.is_local() and not symbol.is_free():
-                return table
+            if table.get_type() != 'class':
+                try:
+                    symbol = table.lookup(self.name)
+                except KeyError:
+                    pass
+                else:
+                    if symbol.is_local() and not symbol.is_free():
+                        return scope.key
+            scope = scope.parent
         return None
 
     @property
@@ -1,15 +1,23 @@
 import ast
 import symtable
-from collections import deque
+import sys
+import time
+from collections import Counter, defaultdict, deque
 from collections.abc import Iterable
+from contextlib import contextmanager
 from functools import singledispatch
 from keyword import kwlist
 from token import INDENT, NAME, OP
 from tokenize import TokenError, tokenize
 from typing import List, Optional
 
-from .util import code_to_lines, debug_time, lines_to_code, logger
-from .visitor import visitor
+from .node import Scope
+from .util import code_to_lines, lines_to_code, logger, timed
+from .visitor import chunk_visitor, module_chunks, visitor
+
+# Approximate sizes (in bytes) of the objects counted by memory_usage()
+_STR_SIZE = sys.getsizeof('')
+_TUPLE_SIZE = sys.getsizeof((0, 0, '', ''))
 
 
 class UnparsableError(Exception):
@@ -35,20 +43,45 @@ class Parser:
         self._locations = {}
         self._nodes = []
         self.lines = []
+        # Snapshot of the symbols (see _snapshot_symbols()) of the last parse
+        self._symbols = []
+        # Nodes whose symtables haven't been released yet (see
+        # releasable_nodes())
+        self._unreleased = []
+        # Line numbers which were modified to fix a syntax error in the last
+        # parse
+        self._fixed_linenos = set()
+        # Chunks of the module which haven't been visited yet (see
+        # visit_pending()), and the nodes of all chunks by index
+        self._pending_chunks = deque()
+        self._chunk_nodes = []
         # Incremented after every parse call
         self.tick = 0
+        # Tuple (`lineno`, `delta`) if the nodes of the last parse were matched
+        # with the old nodes after lines were inserted or deleted (see
+        # _line_shift()), otherwise None
+        self.line_shift = None
+        # Counts how changes were processed ("reuse": nodes outside of the
+        # changed lines were reused, "window"/"diff": all nodes were diffed
+        # within/beyond the changed lines, "shift": all nodes were diffed
+        # after lines were inserted or deleted, "refresh": all nodes were
+        # replaced)
+        self.stats = Counter()
+        # Seconds spent in the phases of the last parse
+        self.timings = Counter()
         # Holds the error of the current and previous run, so the buffer
         # handler knows if error signs need to be updated.
         self.syntax_errors = deque([None, None], maxlen=2)
         self.same_nodes = singledispatch(self.same_nodes)
         self.same_nodes.register(Iterable, self._same_nodes_cursor)
 
-    @debug_time
+    @timed
     def parse(self, *args, **kwargs):
         """Wrapper for `_parse()`.
 
         Raises UnparsableError() if an unrecoverable error occurred.
         """
+        self.timings = Counter()
         try:
             return self._parse(*args, **kwargs)
         except (SyntaxError, RecursionError) as e:
@@ -57,34 +90,300 @@ class Parser:
         finally:
             self.tick += 1
 
-    @debug_time
+    @timed
     def _filter_excluded(self, nodes):
-        return [n for n in nodes if n.hl_group not in self._excluded]
+        # Lazy nodes are kept, so they don't need to be classified yet
+        return [n for n in nodes if n.lazy or n.hl_group not in self._excluded]
 
-    def _parse(self, code, force=False):
+    def _parse(self, code, force=False, view=None):
         """Parse code and return tuple (`add`, `remove`) of added and removed
         nodes since last run. With `force`, all highlights are refreshed, even
         those that didn't change.
+
+        If `view` is a line range (`start`, `stop`) and all highlights are
+        refreshed, only the parts of the code overlapping with it are visited.
+        The remaining nodes are then added by `visit_pending()`. Nodes outside
+        of the view are classified lazily, so the returned nodes may contain
+        lazy nodes of excluded highlight groups.
         """
         self._locations.clear()
-        old_lines = self.lines
         new_lines = code_to_lines(code)
-        minor_change, change_lineno = self._minor_change(old_lines, new_lines)
-        old_nodes = self._nodes
-        new_nodes = self._make_nodes(code, new_lines, change_lineno)
-        # Detecting minor changes keeps us from updating a lot of highlights
-        # while the user is only editing a single line.
-        if minor_change and not force:
-            add, rem, keep = self._diff(old_nodes, new_nodes)
-            self._nodes = keep + add
+        linenos, change_lineno, line_shift = self._detect_change(new_lines)
+        self.line_shift = None
+        ast_root, symtable_root, lines, fixed_linenos = \
+            self._make_tables(code, new_lines, change_lineno)
+        symbols = self._snapshot_symbols(symtable_root)
+        # Kept nodes adopt the IDs of the old nodes, so the new nodes replace
+        # the old ones entirely. Detecting minor changes keeps us from
+        # updating a lot of highlights while the user is only editing a
+        # single line.
+        if linenos is not None and not force:
+            linenos |= fixed_linenos
+            if self._same_symbols(self._symbols, symbols, ()):
+                symbols = self._symbols
+                add, rem, self._nodes = self._parse_reuse(
+                    lines, symtable_root, ast_root, linenos)
+            else:
+                add, rem, self._nodes = self._parse_diff(
+                    lines, symtable_root, ast_root, symbols, linenos)
+        elif line_shift is not None and not force:
+            add, rem, self._nodes = self._parse_shift(lines, symtable_root,
+                                                      ast_root, line_shift)
         else:
-            add, rem = new_nodes, old_nodes
-            self._nodes = add
+            add, rem, self._nodes = self._parse_refresh(
+                lines, symtable_root, ast_root, view)
+        self._symbols = symbols
+        self._fixed_linenos = fixed_linenos
         # Only assign new lines when nodes have been updated accordingly
         self.lines = new_lines
         logger.debug('[%d] nodes: +%d,  -%d', self.tick, len(add), len(rem))
         return (self._filter_excluded(add), self._filter_excluded(rem))
 
+    def _detect_change(self, new_lines):
+        """Return tuple (`linenos`, `change_lineno`, `line_shift`) describing
+        the change from the current lines to `new_lines`.
+
+        For a minor change (see `_minor_change()`), `linenos` is the set of
+        line numbers whose nodes may have changed, otherwise None.
+        `line_shift` is the line shift of other changes (see
+        `_line_shift()`), if any. Changes can't be detected while the last
+        parse has pending chunks, because its nodes are incomplete.
+        """
+        minor_change, change_lineno = self._minor_change(self.lines, new_lines)
+        line_shift = None
+        if not minor_change and self._nodes:
+            line_shift = self._line_shift(self.lines, new_lines)
+        if self._pending_chunks:
+            self._pending_chunks.clear()
+            self._chunk_nodes = []
+            return None, change_lineno, None
+        if not minor_change:
+            return None, change_lineno, line_shift
+        linenos = set(self._fixed_linenos)
+        if change_lineno is not None:
+            linenos.add(change_lineno + 1)
+        return linenos, change_lineno, line_shift
+
+    def _parse_reuse(self, lines, symtable_root, ast_root, linenos):
+        """Return tuple (`add`, `remove`, `nodes`) of the added and removed
+        nodes and all new nodes, visiting only the lines `linenos`.
+
+        No symbol changed, so only the nodes in the changed lines can be
+        different. All others are reused.
+        """
+        self.stats['reuse'] += 1
+        with self._timing('visit'):
+            new_nodes = visitor(lines, symtable_root, ast_root, linenos)
+        self._unreleased += new_nodes
+        old_window = [n for n in self._nodes if n.lineno in linenos]
+        with self._timing('diff'):
+            add, rem, _ = self._diff(old_window, new_nodes)
+        return add, rem, self._splice(self._nodes, new_nodes, linenos)
+
+    @staticmethod
+    def _splice(old_nodes, new_nodes, linenos):
+        """Return the nodes `old_nodes` with the nodes in the lines `linenos`
+        replaced with `new_nodes`, keeping the visit order.
+
+        The new nodes of a line take the places of its old nodes one by one.
+        Surplus new nodes follow the last old node of their line, or precede
+        the first node of a later line if the line had no nodes before.
+        """
+        new_by_line = defaultdict(deque)
+        for node in new_nodes:
+            new_by_line[node.lineno].append(node)
+        last_idx = {}
+        for idx, node in enumerate(old_nodes):
+            if node.lineno in linenos:
+                last_idx[node.lineno] = idx
+        # Lines without old nodes, by line number
+        new_lines = sorted(set(new_by_line) - set(last_idx), reverse=True)
+        nodes = []
+        for idx, node in enumerate(old_nodes):
+            lineno = node.lineno
+            while new_lines and new_lines[-1] < lineno:
+                nodes += new_by_line.pop(new_lines.pop())
+            if lineno not in linenos:
+                nodes.append(node)
+                continue
+            line_nodes = new_by_line.get(lineno)
+            if line_nodes:
+                nodes.append(line_nodes.popleft())
+            if idx == last_idx[lineno] and line_nodes:
+                nodes += line_nodes
+        for lineno in reversed(new_lines):
+            nodes += new_by_line[lineno]
+        return nodes
+
+    def _parse_diff(self, lines, symtable_root, ast_root, symbols, linenos):
+        """Return tuple (`add`, `remove`, `nodes`) like `_parse_reuse()`, but
+        the symbols changed, so all nodes are visited. Only the nodes of the
+        changed symbols outside of `linenos` are diffed if possible (see
+        `_diff_window()`), otherwise all nodes."""
+        old_nodes = self._nodes
+        with self._timing('visit'):
+            new_nodes = visitor(lines, symtable_root, ast_root)
+        self._unreleased = list(new_nodes)
+        with self._timing('diff'):
+            diff = self._diff_window(old_nodes, new_nodes, self._symbols,
+                                     symbols, linenos)
+            if diff is None:
+                self.stats['diff'] += 1
+                add, rem, _ = self._diff(old_nodes, new_nodes)
+            else:
+                self.stats['window'] += 1
+                add, rem = diff
+        return add, rem, new_nodes
+
+    def _parse_shift(self, lines, symtable_root, ast_root, line_shift):
+        """Return tuple (`add`, `remove`, `nodes`) like `_parse_reuse()`.
+
+        Only lines were inserted or deleted, so the nodes after them can be
+        matched with the old nodes shifted by as many lines (see
+        `_line_shift()`).
+        """
+        self.stats['shift'] += 1
+        with self._timing('visit'):
+            new_nodes = visitor(lines, symtable_root, ast_root)
+        self._unreleased = list(new_nodes)
+        with self._timing('diff'):
+            add, rem, _ = self._diff(self._nodes, new_nodes, line_shift)
+        self.line_shift = line_shift
+        return add, rem, new_nodes
+
+    def _parse_refresh(self, lines, symtable_root, ast_root, view):
+        """Return tuple (`add`, `remove`, `nodes`) like `_parse_reuse()`,
+        replacing all old nodes with the nodes in `view` (see
+        `_visit_view()`)."""
+        self.stats['refresh'] += 1
+        with self._timing('visit'):
+            new_nodes = self._visit_view(lines, symtable_root, ast_root, view)
+        self._unreleased = list(new_nodes)
+        return list(new_nodes), self._nodes, new_nodes
+
+    @contextmanager
+    def _timing(self, phase):
+        """Context manager adding the time spent in it to the timings of the
+        `phase`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[phase] += time.perf_counter() - start
+
+    def _visit_view(self, lines, symtable_root, ast_root, view):
+        """Return the nodes of the chunks of the module overlapping with the
+        line range `view`, and queue all other chunks to be visited later.
+
+        Visits the entire module if there is no view or the module can't be
+        split.
+        """
+        chunks = None
+        if view is not None:
+            chunks = module_chunks(symtable_root, ast_root)
+        if chunks is None:
+            return visitor(lines, symtable_root, ast_root, view=view)
+        start, stop = view
+        scope = Scope(symtable_root)
+        self._chunk_nodes = [[] for _ in chunks]
+        nodes = []
+        pending = []
+        for idx, chunk in enumerate(chunks):
+            if chunk[0] <= stop and chunk[1] >= start:
+                self._chunk_nodes[idx] = chunk_visitor(lines, scope, chunk,
+                                                       view)
+                nodes += self._chunk_nodes[idx]
+            else:
+                # Chunks closest to the view are visited first
+                distance = start - chunk[1] if chunk[1] < start else \
+                           chunk[0] - stop
+                pending.append((distance, idx, lines, scope, chunk, view))
+        pending.sort(key=lambda item: item[:2])
+        self._pending_chunks.extend(item[1:] for item in pending)
+        return nodes
+
+    def visit_pending(self):
+        """Visit the next chunk of the module which hasn't been visited by the
+        last parse. Return the added nodes, or None if all chunks have been
+        visited.
+        """
+        if not self._pending_chunks:
+            return None
+        idx, lines, scope, chunk, view = self._pending_chunks.popleft()
+        nodes = chunk_visitor(lines, scope, chunk, view)
+        self._chunk_nodes[idx] = nodes
+        self._unreleased += nodes
+        if self._pending_chunks:
+            self._nodes += nodes
+        else:
+            # All chunks are visited, so restore the order of the nodes
+            self._nodes = [n for nodes in self._chunk_nodes for n in nodes]
+            self._chunk_nodes = []
+        return self._filter_excluded(nodes)
+
+    def releasable_nodes(self):
+        """Return the nodes whose symtables can be released with
+        `release_symtables()`, and stop keeping track of them.
+
+        All symtables of a parse are linked to its module symtable, so they
+        can only be released once all nodes of the parse are classified. Lazy
+        nodes keep them until they are classified on demand. Nodes replaced by
+        a later parse are dropped along with their symtables.
+
+        Returns an empty list while there are chunks of the module which
+        haven't been visited yet, because they share their scopes with the
+        nodes.
+        """
+        if self._pending_chunks or not self._unreleased:
+            return []
+        current = {id(node) for node in self._nodes}
+        nodes_by_root = defaultdict(list)
+        for node in self._unreleased:
+            if id(node) in current:
+                nodes_by_root[node.env.root].append(node)
+        nodes = []
+        self._unreleased = []
+        for root_nodes in nodes_by_root.values():
+            if any(node.lazy for node in root_nodes):
+                self._unreleased += root_nodes
+            else:
+                nodes += root_nodes
+        return nodes
+
+    @staticmethod
+    def release_symtables(nodes):
+        """Release the symtables referenced by the scopes of the classified
+        `nodes`, which keep the entire symtable of a parse alive."""
+        for scope in {node.env for node in nodes}:
+            scope.release()
+
+    def memory_usage(self):
+        """Return an estimate of the bytes retained by the parser as dict
+        with the keys "lines", "nodes" and "symbols".
+
+        Only the containers and objects owned by the parser are counted, not
+        strings shared with the AST, so the estimate is a lower bound. The
+        symtables are released once the nodes are classified, so only the
+        snapshot of their symbols (see `_snapshot_symbols()`) is counted.
+        """
+        lines = self.lines
+        nodes = self._nodes
+        node_size = 0
+        if nodes:
+            # All nodes have the same size, and so have their sort tuples
+            node_size = sys.getsizeof(nodes[0]) + _TUPLE_SIZE
+        # Line strings of ASCII characters take one byte per character
+        lines_size = sum(map(len, lines)) + len(lines) * _STR_SIZE
+        snapshot = self._symbols
+        symbols_size = sys.getsizeof(snapshot) + sum(
+            sys.getsizeof(entry) + sys.getsizeof(entry[3])
+            for entry in snapshot)
+        return {
+            'lines': sys.getsizeof(lines) + lines_size,
+            'nodes': sys.getsizeof(nodes) + len(nodes) * node_size,
+            'symbols': symbols_size,
+        }
+
     def _make_nodes(self, code, lines=None, change_lineno=None):
         """Return nodes in code.
 
@@ -93,6 +392,17 @@ class Parser:
         """
         if lines is None:
             lines = code_to_lines(code)
+        ast_root, symtable_root, lines, _ = \
+            self._make_tables(code, lines, change_lineno)
+        return visitor(lines, symtable_root, ast_root)
+
+    def _make_tables(self, code, lines, change_lineno):
+        """Return tuple (`ast_root`, `symtable_root`, `lines`,
+        `fixed_linenos`) for code.
+
+        If syntax errors were fixed, `lines` are the fixed lines of code and
+        `fixed_linenos` the line numbers which have been modified.
+        """
         try:
             ast_root, fixed_code, fixed_lines, error = \
                 self._fix_syntax_and_make_ast(code, lines, change_lineno)
@@ -100,20 +410,27 @@ class Parser:
             # Apparently, fixing syntax errors failed
             self.syntax_errors.append(e)
             raise
+        fixed_linenos = set()
         if fixed_code is not None:
+            fixed_linenos = {
+                i + 1
+                for i in (error.lineno - 1, change_lineno)
+                if i is not None and lines[i] != fixed_lines[i]
+            }
             code = fixed_code
             lines = fixed_lines
         try:
-            symtable_root = self._make_symtable(code)
+            with self._timing('symtable'):
+                symtable_root = self._make_symtable(code)
         except SyntaxError as e:
             # In some cases, the symtable() call raises a syntax error which
             # hasn't been raised earlier (such as duplicate arguments)
             self.syntax_errors.append(e)
             raise
         self.syntax_errors.append(error)
-        return visitor(lines, symtable_root, ast_root)
+        return ast_root, symtable_root, lines, fixed_linenos
 
-    @debug_time
+    @timed
     def _fix_syntax_and_make_ast(self, code, lines, change_lineno):
         """Try to fix syntax errors in code (if present) and return AST, fixed
         code and list of fixed lines of code.
@@ -127,37 +444,42 @@ class Parser:
         """
         # TODO Cache previous attempt?
         try:
-            return self._make_ast(code), None, None, None
+            with self._timing('ast'):
+                ast_root = self._make_ast(code)
         except SyntaxError as e:
             orig_error = e
             error_idx = e.lineno - 1
+        else:
+            return ast_root, None, None, None
         if not self._fix_syntax:
             # Don't even attempt to fix syntax errors.
             raise orig_error
-        new_lines = lines[:]
-        # Save original line to restore later
-        orig_line = new_lines[error_idx]
-        new_lines[error_idx] = self._fix_line(orig_line)
-        new_code = lines_to_code(new_lines)
-        try:
-            ast_root = self._make_ast(new_code)
-        except SyntaxError:
-            # Restore original line
-            new_lines[error_idx] = orig_line
-            # Fixing the line of the syntax error failed, so try again with the
-            # line of last change.
-            if change_lineno is None or change_lineno == error_idx:
-                # Don't try to fix the changed line if it's unknown or the same
-                # as the one we tried to fix before.
-                raise orig_error
-            new_lines[change_lineno] = self._fix_line(new_lines[change_lineno])
+        with self._timing('fix'):
+            new_lines = lines[:]
+            # Save original line to restore later
+            orig_line = new_lines[error_idx]
+            new_lines[error_idx] = self._fix_line(orig_line)
             new_code = lines_to_code(new_lines)
             try:
                 ast_root = self._make_ast(new_code)
             except SyntaxError:
-                # All fixing attempts failed, so raise original syntax error.
-                raise orig_error
-        return ast_root, new_code, new_lines, orig_error
+                # Restore original line
+                new_lines[error_idx] = orig_line
+                # Fixing the line of the syntax error failed, so try again with the
+                # line of last change.
+                if change_lineno is None or change_lineno == error_idx:
+                    # Don't try to fix the changed line if it's unknown or the same
+                    # as the one we tried to fix before.
+                    raise orig_error
+                new_lines[change_lineno] = self._fix_line(
+                    new_lines[change_lineno])
+                new_code = lines_to_code(new_lines)
+                try:
+                    ast_root = self._make_ast(new_code)
+                except SyntaxError:
+                    # All fixing attempts failed, so raise original syntax error.
+                    raise orig_error
+            return ast_root, new_code, new_lines, orig_error
 
     @staticmethod
     def _fix_line(line):
@@ -193,13 +515,13 @@ class Parser:
         return text
 
     @staticmethod
-    @debug_time
+    @timed
     def _make_ast(code):
         """Return AST for code."""
         return ast.parse(code)
 
     @staticmethod
-    @debug_time
+    @timed
     def _make_symtable(code):
         """Return symtable for code."""
         return symtable.symtable(code, '?', 'exec')
@@ -236,46 +558,149 @@ class Parser:
             return (True, diff_lineno)
 
     @staticmethod
-    @debug_time
-    def _diff(old_nodes, new_nodes):
+    def _line_shift(old_lines, new_lines):
+        """Return tuple (`lineno`, `delta`) if `new_lines` only differ from
+        `old_lines` by lines inserted or deleted after the line `lineno`,
+        where `delta` is the number of inserted (or negative number of
+        deleted) lines. Otherwise, return None.
+        """
+        delta = len(new_lines) - len(old_lines)
+        if delta == 0:
+            return None
+        lineno = 0
+        max_lineno = min(len(old_lines), len(new_lines))
+        while lineno < max_lineno and \
+                old_lines[lineno] == new_lines[lineno]:
+            lineno += 1
+        if delta > 0:
+            same = old_lines[lineno:] == new_lines[lineno + delta:]
+        else:
+            same = old_lines[lineno - delta:] == new_lines[lineno:]
+        return (lineno, delta) if same else None
+
+    @staticmethod
+    def _snapshot_symbols(symtable_root):
+        """Return a snapshot of the symbols declared in all scopes.
+
+        The snapshot is a list of (type, name, number of children, symbols)
+        tuples, one per symtable in depth-first order, where symbols maps
+        symbol names to their flags.
+        """
+        # pylint: disable=protected-access
+        snapshot = []
+        stack = [symtable_root._table]
+        while stack:
+            table = stack.pop()
+            snapshot.append(
+                (table.type, table.name, len(table.children), table.symbols))
+            stack += table.children
+        return snapshot
+
+    @staticmethod
+    def _same_symbols(old_symbols, new_symbols, names):
+        """Return whether the symtable snapshots `old_symbols` and
+        `new_symbols` are the same, ignoring the symbols in `names`."""
+        if len(old_symbols) != len(new_symbols):
+            return False
+        for old, new in zip(old_symbols, new_symbols):
+            # Compare type, name and number of children first
+            if old[:3] != new[:3]:
+                return False
+            old_syms = old[3]
+            new_syms = new[3]
+            if old_syms == new_syms:
+                continue
+            old_syms = {k: v for k, v in old_syms.items() if k not in names}
+            new_syms = {k: v for k, v in new_syms.items() if k not in names}
+            if old_syms != new_syms:
+                return False
+        return True
+
+    @timed
+    def _diff_window(self, old_nodes, new_nodes, old_symbols, new_symbols,
+                     linenos):
+        """Return tuple (`add`, `remove`) like `_diff()`, but only compare the
+        nodes in the lines `linenos` and the nodes sharing a name with them.
+
+        All other nodes are only affected by the change if the declared
+        symbols of a scope changed. Otherwise, they adopt the IDs of the old
+        nodes one by one. Returns None if a full diff is required.
+        """
+        names = set()
+        for node in old_nodes:
+            if node.lineno in linenos:
+                names.add(node.name)
+                names.add(node.symname)
+        for node in new_nodes:
+            if node.lineno in linenos:
+                names.add(node.name)
+                names.add(node.symname)
+        if not self._same_symbols(old_symbols, new_symbols, names):
+            return None
+        old_window, old_rest = self._split_window(old_nodes, linenos, names)
+        new_window, new_rest = self._split_window(new_nodes, linenos, names)
+        if len(old_rest) != len(new_rest):
+            return None
+        for old, new in zip(old_rest, new_rest):
+            if old.lineno != new.lineno or old.col != new.col or \
+               old.hl_group != new.hl_group:
+                return None
+            new.id = old.id
+        return self._diff(old_window, new_window)[:2]
+
+    @staticmethod
+    def _split_window(nodes, linenos, names):
+        """Return tuple (`window`, `rest`) of the nodes in the lines `linenos`
+        or with one of the `names`, and all other nodes."""
+        window = []
+        rest = []
+        for node in nodes:
+            if node.lineno in linenos or node.name in names:
+                window.append(node)
+            else:
+                rest.append(node)
+        return window, rest
+
+    @staticmethod
+    @timed
+    def _diff(old_nodes, new_nodes, line_shift=None):
         """Return difference between iterables of nodes old_nodes and new_nodes
         as three lists of nodes to add, remove and keep.
+
+        Nodes are matched by their comparison tuples, so neither list needs to
+        be sorted and the diff takes linear time. With `line_shift` (see
+        `_line_shift()`), the old nodes after the changed lines are matched as
+        if they were shifted, and old nodes in deleted lines are removed.
         """
-        add_iter = iter(sorted(new_nodes))
-        rem_iter = iter(sorted(old_nodes))
-        add_nodes = []
+        old_by_tup = {}
         rem_nodes = []
+        for node in old_nodes:
+            tup = node._tup  # pylint: disable=protected-access
+            if line_shift is not None and tup[0] > line_shift[0]:
+                lineno, delta = line_shift
+                if tup[0] <= lineno - delta:
+                    rem_nodes.append(node)
+                    continue
+                tup = (tup[0] + delta, *tup[1:])
+            if old_by_tup.setdefault(tup, node) is not node:
+                # Duplicates can't be matched unambiguously, so replace them
+                rem_nodes.append(node)
+        add_nodes = []
         keep_nodes = []
-        try:
-            add = rem = None
-            while True:
-                if add == rem:
-                    if add is not None:
-                        keep_nodes.append(add)
-                        # A new node needs to adopt the highlight ID of
-                        # corresponding currently highlighted node
-                        add.id = rem.id
-                    add = rem = None
-                    add = next(add_iter)
-                    rem = next(rem_iter)
-                elif add < rem:
-                    add_nodes.append(add)
-                    add = None
-                    add = next(add_iter)
-                elif rem < add:
-                    rem_nodes.append(rem)
-                    rem = None
-                    rem = next(rem_iter)
-        except StopIteration:
-            if add is not None:
-                add_nodes.append(add)
-            if rem is not None:
-                rem_nodes.append(rem)
-            add_nodes += list(add_iter)
-            rem_nodes += list(rem_iter)
+        pop = old_by_tup.pop
+        for node in new_nodes:
+            old = pop(node._tup, None)  # pylint: disable=protected-access
+            if old is None:
+                add_nodes.append(node)
+                continue
+            # A new node needs to adopt the highlight ID of corresponding
+            # currently highlighted node
+            node.id = old.id
+            keep_nodes.append(node)
+        rem_nodes += old_by_tup.values()
         return add_nodes, rem_nodes, keep_nodes
 
-    @debug_time
+    @timed
     def node_at(self, cursor):
         """Return node at cursor position."""
         lineno, col = cursor
@@ -289,20 +714,20 @@ class Parser:
         """Return nodes with the same scope as cur_node.
 
         The same scope is to be understood as all nodes with the same base
-        symtable. In some cases this can be ambiguous.
+        scope. In some cases this can be ambiguous.
         """
         if use_target:
             target = cur_node.target
             if target is not None:
                 cur_node = target
         cur_name = cur_node.name
-        base_table = cur_node.base_table()
+        base_scope = cur_node.base_scope
         for node in self._nodes:
             if node.name != cur_name:
                 continue
             if not mark_original and node is cur_node:
                 continue
-            if node.base_table() == base_table:
+            if node.base_scope == base_scope:
                 yield node
 
     def _same_nodes_cursor(self, cursor, mark_original=True, use_target=True):
@@ -1,6 +1,8 @@
 from __future__ import annotations
 
+import os
 import sys
+import threading
 from functools import partial, wraps
 from typing import TYPE_CHECKING, List, Optional, Sequence, cast
 
@@ -12,6 +14,7 @@ import pynvim.api
 
 from .handler import BufferHandler
 from .node import hl_groups
+from .util import metrics
 
 # pylint: disable=consider-using-f-string
 
@@ -60,7 +63,13 @@ class Plugin:
         self._handlers = {}
         # The currently active buffer handler
         self._cur_handler: Optional[BufferHandler] = None
+        # A mapping (window ID -> handler of the buffer shown in the window)
+        self._window_handlers = {}
         self._options = None
+        # The latest cursor move as tuple (handler, cursor) whose selected
+        # nodes are yet to be marked, and the timer to mark them
+        self._moved_cursor = None
+        self._cursor_timer = None
 
         # Python version check
         if (3, 7) <= sys.version_info <= (3, 13, 9999):
@@ -81,6 +90,7 @@ class Plugin:
         __init__ because vim itself may not be fully started up.
         """
         self._options = Options(self._vim)
+        metrics.enabled = self._options.metrics
 
     def echo(self, *msgs):
         msg = ' '.join([str(m) for m in msgs])
@@ -94,10 +104,10 @@ class Plugin:
     # buffer handler is completed before other events are handled.
     @pynvim.function('SemshiBufEnter', sync=True)
     def event_buf_enter(self, args):
-        buf_num, view_start, view_stop = args
+        buf_num, view_start, view_stop, window = args
         self._select_handler(buf_num)
         assert self._cur_handler is not None
-        self._update_viewport(view_start, view_stop)
+        self._update_viewport(view_start, view_stop, window)
         self._cur_handler.update()
         self._mark_selected()
 
@@ -109,6 +119,12 @@ class Plugin:
     def event_buf_wipeout(self, args):
         self._remove_handler(args[0])
 
+    @pynvim.function('SemshiWinClosed', sync=False)
+    def event_win_closed(self, args):
+        handler = self._window_handlers.pop(args[0], None)
+        if handler is not None:
+            handler.remove_viewport(args[0])
+
     @pynvim.function('SemshiVimResized', sync=False)
     def event_vim_resized(self, args):
         self._update_viewport(*args)
@@ -116,13 +132,15 @@ class Plugin:
 
     @pynvim.function('SemshiCursorMoved', sync=False)
     def event_cursor_moved(self, args):
+        view_start, view_stop, row, col, window = args
         if self._cur_handler is None:
             # CursorMoved may trigger before BufEnter, so select the buffer if
             # we didn't enter it yet.
-            self.event_buf_enter((self._vim.current.buffer.number, *args))
+            self.event_buf_enter((self._vim.current.buffer.number, view_start,
+                                  view_stop, window))
             return
-        self._update_viewport(*args)
-        self._mark_selected()
+        self._update_viewport(view_start, view_stop, window)
+        self._schedule_mark_selected((row, col))
 
     @pynvim.function('SemshiTextChanged', sync=False)
     def event_text_changed(self, _):
@@ -134,6 +152,8 @@ class Plugin:
 
     @pynvim.autocmd('VimLeave', sync=True)
     def event_vim_leave(self):
+        if self._cursor_timer is not None:
+            self._cursor_timer.cancel()
         for handler in self._handlers.values():
             handler.shutdown()
 
@@ -182,8 +202,13 @@ class Plugin:
             return
         self._attach_listeners()
         self._select_handler(self._vim.current.buffer)
-        self._update_viewport(*self._vim.eval('[line("w0"), line("w$")]'))
-        self.highlight()
+        self._update_viewport(
+            *self._vim.eval('[line("w0"), line("w$"), win_getid()]'))
+        if self._options.async_first_paint:
+            assert self._cur_handler is not None
+            self._cur_handler.update(force=True, progressive=True)
+        else:
+            self.highlight()
 
     @subcommand(needs_handler=True)
     def disable(self):
@@ -246,7 +271,7 @@ class Plugin:
             '- current handler: {handler}',
             '- handlers: {handlers}',
             '- syntax error: {syntax_error}',
-        ]).format(
+        ] + self._memory_lines() + self._update_stats_lines()).format(
             attached=attached and "attached" or "detached",
             bufnr=str(buffer.number),
             handler=self._cur_handler,
@@ -254,6 +279,120 @@ class Plugin:
             syntax_error=syntax_error,
         ))
 
+    def _memory_lines(self) -> List[str]:
+        """Return lines showing the estimated memory retained by the current
+        handler and by all handlers."""
+        lines = []
+        if self._cur_handler:
+            usage = self._cur_handler.memory_usage()
+            lines.append('- memory: %s (%s)' %
+                         (format_size(usage.pop('total')), ', '.join(
+                             '%s %s' % (key, format_size(size))
+                             for key, size in usage.items())))
+        total = sum(handler.memory_usage()['total']
+                    for handler in self._handlers.values())
+        warm = sum(handler.warm for handler in self._handlers.values())
+        budget = self._options.memory_budget if self._options else 0
+        lines.append('- memory of all handlers: %s (%d warm)%s' %
+                     (format_size(total), warm, ' (budget: %s)' %
+                      format_size(budget * 1024 * 1024) if budget > 0 else ''))
+        return lines
+
+    def _update_stats_lines(self) -> List[str]:
+        """Return lines showing the phase timings (in ms) of the most recent
+        updates of the current handler."""
+        if not self._cur_handler or not self._cur_handler.update_stats:
+            return []
+        phases = [
+            'fetch', 'ast', 'fix', 'symtable', 'visit', 'diff', 'highlight',
+            'pending', 'total'
+        ]
+        header = ''.join('%10s' % p for p in phases)
+        lines = [
+            '- recent updates (ms):', header + '  +add/-rem  nodes/pending'
+        ]
+        for stats in self._cur_handler.update_stats:
+            timings = stats['timings']
+            line = ''.join('%10.2f' % (timings.get(p, 0) * 1000)
+                           for p in phases)
+            line += '  %9s  %s' % ('+%d/-%d' %
+                                   (stats['add'], stats['rem']), '%d/%d' %
+                                   (stats['nodes'], stats['pending']))
+            if stats['error']:
+                line += '  (syntax error)'
+            lines.append(line)
+        # Escape braces for format()
+        return [line.replace('{', '{{').replace('}', '}}') for line in lines]
+
+    @subcommand(needs_handler=True, silent_fail=False)
+    def profile(self, *args):
+        assert self._cur_handler
+        action, *args = args or [None]
+        if action == 'start' and set(args) <= {'memory'}:
+            if not self._cur_handler.start_profile(memory=bool(args)):
+                self.echo_error('Already profiling this buffer.')
+                return
+            self.echo('Profiling updates of this buffer.')
+            return
+        if action == 'stop' and len(args) == 1:
+            path = os.path.expanduser(args[0])
+            try:
+                paths = self._cur_handler.stop_profile(path)
+            except OSError as e:
+                self.echo_error('Failed to write profile: %s' % e)
+                return
+            if paths is None:
+                self.echo('Profile will be written to %s once the running '
+                          'update is done.' % path)
+                return
+            if not paths:
+                self.echo_error('Not profiling this buffer.')
+                return
+            self.echo('Profile written to %s' % ', '.join(paths))
+            return
+        self.echo_error('Usage: Semshi profile start [memory] | stop <file>')
+
+    @subcommand
+    def stats(self, action=None, path=None):
+        if action == 'clear':
+            metrics.clear()
+            return
+        if action == 'dump':
+            if not path:
+                self.echo_error('Usage: Semshi stats dump <file>')
+                return
+            path = os.path.expanduser(path)
+            try:
+                metrics.dump(path)
+            except OSError as e:
+                self.echo_error('Failed to write stats: %s' % e)
+                return
+            self.echo('Stats written to %s' % path)
+            return
+        if action is not None:
+            self.echo_error('Unknown stats action: %s' % action)
+            return
+        if not metrics.enabled:
+            self.echo('Timing metrics are disabled. '
+                      'Set g:semshi#metrics to enable them.')
+            return
+        lines = [
+            '%-40s %7s %10s %9s %9s %9s' %
+            ('label', 'count', 'total', 'p50', 'p95', 'max')
+        ]
+        summary = sorted(metrics.summary().items(),
+                         key=lambda item: -item[1]['total'])
+        for label, stats in summary:
+            lines.append('%-40s %7d %8.1fms %7.2fms %7.2fms %7.2fms' % (
+                label,
+                stats['count'],
+                stats['total'] * 1000,
+                stats['p50'] * 1000,
+                stats['p95'] * 1000,
+                stats['max'] * 1000,
+            ))
+        self.echo('\n'.join(lines))
+
     def _select_handler(self, buf_or_buf_num):
         """Select handler for `buf_or_buf_num`."""
         if isinstance(buf_or_buf_num, int):
@@ -263,14 +402,45 @@ class Plugin:
             buf = buf_or_buf_num
             buf_num = buf.number
         try:
-            handler = self._handlers[buf_num]
+            # Handlers are kept in the order they were last selected
+            handler = self._handlers.pop(buf_num)
         except KeyError:
             if buf is None:
                 buf = self._vim.buffers[buf_num]
             assert self._options is not None, "must have been initialized"
             handler = BufferHandler(buf, self._vim, self._options)
-            self._handlers[buf_num] = handler
+        self._handlers[buf_num] = handler
         self._cur_handler = handler
+        self._evict_handlers()
+
+    def _evict_handlers(self):
+        """Evict the state of the least recently selected handlers while there
+        are more warm handlers than allowed or the memory of all handlers
+        exceeds the memory budget."""
+        assert self._options is not None, "must have been initialized"
+        budget = self._options.memory_budget * 1024 * 1024
+        max_warm = self._options.max_warm_handlers
+        if budget <= 0 and max_warm <= 0:
+            return
+        usages = {}
+        if budget > 0:
+            usages = {
+                handler: handler.memory_usage()['total']
+                for handler in self._handlers.values()
+            }
+        total = sum(usages.values())
+        warm = [
+            handler for handler in self._handlers.values()
+            if handler.warm and handler is not self._cur_handler
+        ]
+        # The current handler is warm once it has been updated
+        excess = len(warm) + 1 - max_warm if max_warm > 0 else 0
+        for handler in warm:
+            if excess <= 0 and total <= budget:
+                break
+            if handler.evict():
+                excess -= 1
+                total -= usages.get(handler, 0)
 
     def _remove_handler(self, buf_or_buf_num):
         """Remove handler for buffer with the number `buf_num`."""
@@ -282,21 +452,68 @@ class Plugin:
             handler = self._handlers.pop(buf_num)
         except KeyError:
             return
-        else:
-            handler.shutdown()
-
-    def _update_viewport(self, start, stop):
-        if self._cur_handler:
-            self._cur_handler.viewport(start, stop)
+        handler.shutdown()
+        self._window_handlers = {
+            window: h
+            for window, h in self._window_handlers.items()
+            if h is not handler
+        }
+
+    def _update_viewport(self, start, stop, window=0):
+        handler = self._cur_handler
+        if not handler:
+            return
+        # A window showing another buffer now doesn't need the highlights of
+        # the previous one anymore
+        old_handler = self._window_handlers.get(window)
+        if old_handler is not None and old_handler is not handler:
+            old_handler.remove_viewport(window)
+        self._window_handlers[window] = handler
+        handler.viewport(start, stop, window)
+
+    def _schedule_mark_selected(self, cursor=None):
+        """Mark the nodes selected at `cursor` after the cursor delay, once
+        the events received until then have been handled.
+
+        Of a burst of cursor moves (e.g. while holding a key), only the latest
+        cursor position is marked.
+        """
+        assert self._options is not None, "must have been initialized"
+        if not self._options.mark_selected_nodes:
+            return
+        scheduled = self._moved_cursor is not None
+        self._moved_cursor = (self._cur_handler, cursor)
+        if scheduled:
+            return
 
-    def _mark_selected(self):
+        def mark_selected():
+            self._cursor_timer = None
+            handler, cursor = self._moved_cursor
+            self._moved_cursor = None
+            # The buffer may have been left in the meantime
+            if handler is self._cur_handler:
+                self._mark_selected(cursor)
+
+        delay = self._options.cursor_delay
+        if delay <= 0:
+            self._vim.async_call(mark_selected)
+            return
+        timer = threading.Timer(delay,
+                                partial(self._vim.async_call, mark_selected))
+        self._cursor_timer = timer
+        timer.start()
+
+    def _mark_selected(self, cursor=None):
+        """Mark the nodes selected at `cursor`, or at the cursor of the
+        current window if not given."""
         assert self._options is not None, "must have been initialized"
         if not self._options.mark_selected_nodes:
             return
         try:
             handler = self._cur_handler
             if handler:
-                cursor = self._vim.current.window.cursor
+                if cursor is None:
+                    cursor = self._vim.current.window.cursor
                 handler.mark_selected(cursor)
         except pynvim.api.NvimError as ex:
             # Ignore "Invalid window ID" errors (see wookayin/semshi#3)
@@ -317,6 +534,17 @@ class Plugin:
         return self._vim.eval('get(b:, "semshi_attached", v:false)')
 
 
+def format_size(size):
+    """Return the number of bytes `size` in human-readable form."""
+    if size < 1024:
+        return '%d B' % size
+    for unit in ('KiB', 'MiB', 'GiB'):
+        size /= 1024
+        if size < 1024 or unit == 'GiB':
+            break
+    return '%.1f %s' % (size, unit)
+
+
 class Options:
     """Plugin options.
 
@@ -334,6 +562,15 @@ class Options:
         'tolerate_syntax_errors': True,
         'update_delay_factor': .0,
         'self_to_attribute': True,
+        'cache_dir': '',
+        'async_first_paint': True,
+        'metrics': False,
+        'memory_budget': 0,
+        'max_warm_handlers': 20,
+        'lua_highlights': False,
+        'cursor_delay': .0,
+        'viewport_lookahead': 1.0,
+        'idle_paint_delay': 1.0,
     }
     filetypes: List[str]
     excluded_hl_groups: List[str]
@@ -346,6 +583,15 @@ class Options:
     tolerate_syntax_errors: bool
     update_delay_factor: float
     self_to_attribute: bool
+    cache_dir: str
+    async_first_paint: bool
+    metrics: bool
+    memory_budget: float
+    max_warm_handlers: int
+    lua_highlights: bool
+    cursor_delay: float
+    viewport_lookahead: float
+    idle_paint_delay: float
 
     def __init__(self, vim: pynvim.api.Nvim):
         for key, val_default in Options._defaults.items():
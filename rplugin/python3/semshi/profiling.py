@@ -0,0 +1,107 @@
+import cProfile
+import threading
+import tracemalloc
+
+from .util import logger
+
+
+class UpdateProfiler:
+    """Profiles the update steps of a buffer handler with cProfile, and
+    optionally traces memory allocations with tracemalloc.
+
+    Update steps run in the update thread or (when synchronous) in the main
+    thread, which the update thread may be waiting for. So stopping never
+    blocks, but leaves writing the profile to the profiled step if one is
+    running.
+    """
+
+    def __init__(self):
+        self._profiler = None
+        self._memory = False
+        # Whether tracemalloc was started by start()
+        self._started_tracemalloc = False
+        self._lock = threading.Lock()
+        # The profile to write once profiling stopped, as tuple (`profiler`,
+        # `path`, `memory`, `stop_tracemalloc`) (see stop())
+        self._dump = None
+        self._dump_lock = threading.Lock()
+
+    def start(self, memory=False):
+        """Profile all following update steps. With `memory`, also trace
+        memory allocations.
+
+        Return False without changing anything if already profiling.
+        """
+        if self._profiler is not None:
+            return False
+        self._profiler = cProfile.Profile()
+        self._memory = memory
+        self._started_tracemalloc = memory and not tracemalloc.is_tracing()
+        if self._started_tracemalloc:
+            tracemalloc.start()
+        return True
+
+    def stop(self, path):
+        """Stop profiling and write the profile stats to the file `path`, and
+        the memory snapshot to `path` + '.tracemalloc'.
+
+        Return the paths of the written files, an empty list if not profiling,
+        or None if an update step is being profiled, in which case the step
+        writes the files once it's done.
+        """
+        profiler = self._profiler
+        if profiler is None:
+            return []
+        self._profiler = None
+        self._dump = (profiler, path, self._memory, self._started_tracemalloc)
+        # The profiled update step may be waiting for the main thread, so we
+        # must not block.
+        # pylint: disable=consider-using-with
+        if not self._lock.acquire(blocking=False):
+            return None
+        self._lock.release()
+        return self._write()
+
+    def _write(self):
+        """Write the profile requested by `stop()` unless another thread has
+        taken it already. Return the paths of the written files, or None if
+        there was no profile to write."""
+        with self._dump_lock:
+            dump, self._dump = self._dump, None
+        if dump is None:
+            return None
+        profiler, path, memory, stop_tracemalloc = dump
+        profiler.dump_stats(path)
+        paths = [path]
+        if memory and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            # Keep tracing if it was already running before profiling
+            if stop_tracemalloc:
+                tracemalloc.stop()
+            snapshot.dump(path + '.tracemalloc')
+            paths.append(path + '.tracemalloc')
+        return paths
+
+    def run(self, func, *args, **kwargs):
+        """Run the update step `func(*args, **kwargs)`, profiled if profiling
+        is active."""
+        profiler = self._profiler
+        # A profiler can't profile two threads at once. If the lock is held
+        # by the update thread, it may be waiting for the main thread, so we
+        # must not block.
+        # pylint: disable=consider-using-with
+        if profiler is None or not self._lock.acquire(blocking=False):
+            func(*args, **kwargs)
+            return
+        try:
+            if self._profiler is profiler:
+                profiler.runcall(func, *args, **kwargs)
+            else:
+                # Profiling stopped in the meantime
+                func(*args, **kwargs)
+        finally:
+            self._lock.release()
+            try:
+                self._write()
+            except OSError as e:
+                logger.error('Failed to write profile: %s', e)
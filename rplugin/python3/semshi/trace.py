@@ -0,0 +1,125 @@
+"""Recording of editing sessions, to replay them with script/replay.py.
+
+A trace is a file of JSON objects, one per line. The first one describes the
+buffer (`lines` and `name`), all others are events with a `time` (in seconds
+since the start of the session) and one of these types:
+
+- {"event": "edit", "start": s, "end": e, "lines": [...]}: The lines from `s`
+  to `e` (0-based, end-exclusive) were replaced with `lines`.
+- {"event": "viewport", "start": s, "stop": e, "window": w}: The visible lines
+  of the window with the ID `w` are from `s` to `e` (1-based).
+- {"event": "remove_viewport", "window": w}: The window with the ID `w`
+  doesn't show the buffer anymore.
+- {"event": "cursor", "cursor": [row, col]}: The cursor moved.
+"""
+import json
+import os
+import threading
+import time
+
+from .util import logger
+
+
+class TraceRecorder:
+    """Records the changes of the buffer `name` to the trace file `path`."""
+
+    def __init__(self, path, name=''):
+        self._path = path
+        self._name = name
+        self._file = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._lines = None
+        self._cursor = None
+        # Events before the initial buffer has been recorded
+        self._queued = []
+
+    @classmethod
+    def from_env(cls, buf):
+        """Return a recorder for the buffer `buf` if the environment variable
+        SEMSHI_TRACE_DIR is set, otherwise None."""
+        directory = os.environ.get('SEMSHI_TRACE_DIR')
+        if not directory:
+            return None
+        filename = 'semshi-%d-%d-%s.jsonl' % (os.getpid(), buf.number,
+                                              time.strftime('%Y%m%d%H%M%S'))
+        return cls(os.path.join(directory, filename), buf.name)
+
+    def _write(self, obj):
+        # Requires the lock, so the header is always written first
+        if self._closed:
+            return
+        try:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self._path) or '.', exist_ok=True)
+                # pylint: disable=consider-using-with
+                self._file = open(self._path, 'w', encoding='utf-8')
+            self._file.write(json.dumps(obj, separators=(',', ':')) + '\n')
+            self._file.flush()
+        except OSError as e:
+            logger.debug('failed to write trace %s: %s', self._path, e)
+
+    def _event(self, event, **data):
+        data['time'] = round(time.monotonic() - self._start, 4)
+        data['event'] = event
+        with self._lock:
+            if self._lines is None:
+                self._queued.append(data)
+                return
+            self._write(data)
+
+    def lines(self, lines):
+        """Record the current `lines` of the buffer. The first call records
+        the initial buffer, later ones record the changed lines as edit."""
+        with self._lock:
+            old = self._lines
+            if old is None:
+                self._write({'lines': lines, 'name': self._name})
+                for data in self._queued:
+                    self._write(data)
+                self._queued = []
+            self._lines = lines
+        if old is None or old == lines:
+            return
+        # Only record the changed lines between common head and tail
+        start = 0
+        max_start = min(len(old), len(lines))
+        while start < max_start and old[start] == lines[start]:
+            start += 1
+        end = 0
+        max_end = max_start - start
+        while end < max_end and old[-end - 1] == lines[-end - 1]:
+            end += 1
+        self._event('edit',
+                    start=start,
+                    end=len(old) - end,
+                    lines=lines[start:len(lines) - end])
+
+    def viewport(self, start, stop, window=0):
+        self._event('viewport', start=start, stop=stop, window=window)
+
+    def remove_viewport(self, window):
+        self._event('remove_viewport', window=window)
+
+    def cursor(self, cursor):
+        cursor = list(cursor)
+        if cursor == self._cursor:
+            return
+        self._cursor = cursor
+        self._event('cursor', cursor=cursor)
+
+    def close(self):
+        """Close the trace file. Later events aren't recorded anymore."""
+        with self._lock:
+            self._closed = True
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_trace(path):
+    """Read the trace file `path` and return tuple (`buffer`, `events`)."""
+    with open(path, encoding='utf-8') as f:
+        buffer, *events = [json.loads(line) for line in f if line.strip()]
+    return buffer, events
@@ -1,7 +1,10 @@
 import functools
+import json
 import logging
 import os
+import threading
 import time
+from collections import Counter, defaultdict, deque
 
 
 def lines_to_code(lines):
@@ -12,33 +15,103 @@ def code_to_lines(code):
     return code.split('\n')
 
 
-def debug_time(label_or_callable=None, detail=None):
+def merge_ranges(ranges):
+    """Return the line ranges `ranges` of (`start`, `stop`) merged into a
+    sorted list of disjoint ranges."""
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            if stop > merged[-1][1]:
+                merged[-1] = (merged[-1][0], stop)
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+class Metrics:
+    """In-memory timings of labeled operations.
+
+    Keeps the number of calls, total and maximum time for each label, plus
+    the most recent times to compute percentiles. Nothing is recorded unless
+    `enabled` is set.
+    """
+
+    # Number of most recent times kept per label
+    SAMPLES = 1000
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._totals = defaultdict(float)
+        self._maxima = defaultdict(float)
+        self._samples = defaultdict(lambda: deque(maxlen=self.SAMPLES))
+
+    def add(self, label, seconds):
+        """Record that the operation `label` took `seconds`."""
+        with self._lock:
+            self._counts[label] += 1
+            self._totals[label] += seconds
+            if seconds > self._maxima[label]:
+                self._maxima[label] = seconds
+            self._samples[label].append(seconds)
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+            self._totals.clear()
+            self._maxima.clear()
+            self._samples.clear()
+
+    def summary(self):
+        """Return a dict of labels to dicts with the `count`, `total`, `p50`,
+        `p95` and `max` time in seconds."""
+        with self._lock:
+            summary = {}
+            for label, count in self._counts.items():
+                samples = sorted(self._samples[label])
+                summary[label] = {
+                    'count': count,
+                    'total': self._totals[label],
+                    'p50': samples[len(samples) // 2],
+                    'p95': samples[int(.95 * (len(samples) - 1))],
+                    'max': self._maxima[label],
+                }
+            return summary
+
+    def dump(self, path):
+        """Write the summary as JSON to the file `path`."""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+
+metrics = Metrics()
+
+
+def timed(label_or_func=None):
+    """Decorator to record the time of every call of a function in `metrics`
+    under the label `label_or_func` (or the qualified name of the function).
+    """
 
     def inner(func):
+        label = label_or_func
+        if not isinstance(label, str):
+            label = func.__qualname__
 
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            t = time.time()
-            res = func(*args, **kwargs)
-            label = label_or_callable
-            if not isinstance(label, str):
-                try:
-                    label = func.__name__
-                except AttributeError:
-                    label = func.__class__.__name__
-            text = 'TIME %s: %f ' % (label, time.time() - t)
-            if detail is not None:
-                if callable(detail):
-                    text += detail(*args, **kwargs)
-                else:
-                    text += detail.format(*args, **kwargs)
-            logger.debug(text)
-            return res
+            if not metrics.enabled:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.add(label, time.perf_counter() - start)
 
         return wrapper
 
-    if callable(label_or_callable):
-        return inner(label_or_callable)
+    if callable(label_or_func):
+        return inner(label_or_func)
     return inner
 
 
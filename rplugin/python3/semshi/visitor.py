@@ -2,12 +2,14 @@
 import ast
 import contextlib
 import sys
+from bisect import bisect_right
+from collections import Counter
 from itertools import count
 from token import NAME, OP
 from tokenize import tokenize
 
-from .node import ATTRIBUTE, IMPORTED, PARAMETER_UNUSED, SELF, Node
-from .util import debug_time
+from .node import ATTRIBUTE, IMPORTED, PARAMETER_UNUSED, SELF, Node, Scope
+from .util import timed
 
 # PEP-695 type statement (Python 3.12+)
 if sys.version_info >= (3, 12):
@@ -17,6 +19,9 @@ else:
 
 HAS_PY313 = sys.version_info >= (3, 13)
 
+# Minimum number of lines of a chunk of top-level statements
+CHUNK_SIZE = 300
+
 # Node types which introduce a new scope and child symboltable
 BLOCKS = (
     ast.Module,
@@ -64,24 +69,76 @@ def advance(tokens, s=None, type=NAME):
     return next(t for t in tokens if t.type == type and cond(t))
 
 
-@debug_time
-def visitor(lines, symtable_root, ast_root):
-    visitor = Visitor(lines, symtable_root)
+@timed
+def visitor(lines, symtable_root, ast_root, linenos=None, view=None):
+    visitor = Visitor(lines, symtable_root, linenos, view)
     visitor.visit(ast_root)
     return visitor.nodes
 
 
+def module_chunks(symtable_root, ast_root, size=CHUNK_SIZE):
+    """Split the top-level statements of the module into chunks of at least
+    `size` lines which can be visited independently.
+
+    Returns a list of tuples (`start`, `stop`, `statements`, `tables`) where
+    `start` and `stop` are the first and last line of the chunk and `tables`
+    are the child symtables of the module belonging to its statements, or None
+    if the module can't be split.
+    """
+    statements = ast_root.body
+    # Statements don't have an end line before Python 3.8
+    if not statements or not hasattr(statements[0], 'end_lineno'):
+        return None
+    chunks = []
+    for stmt in statements:
+        # Decorators precede the definition
+        start = min(
+            [stmt.lineno] +
+            [d.lineno for d in stmt.__dict__.get('decorator_list', ())])
+        # Statements sharing a line must stay in the same chunk
+        if chunks and (start <= chunks[-1][1]
+                       or chunks[-1][1] - chunks[-1][0] + 1 < size):
+            chunk = chunks[-1]
+            chunk[1] = max(chunk[1], stmt.end_lineno)
+            chunk[2].append(stmt)
+        else:
+            chunks.append([start, stmt.end_lineno, [stmt], []])
+    if len(chunks) < 2:
+        return None
+    starts = [chunk[0] for chunk in chunks]
+    for table in sorted(symtable_root.get_children(),
+                        key=lambda st: st.get_lineno()):
+        idx = max(bisect_right(starts, table.get_lineno()) - 1, 0)
+        chunks[idx][3].append(table)
+    return [tuple(chunk) for chunk in chunks]
+
+
+@timed
+def chunk_visitor(lines, scope, chunk, view=None):
+    visitor = Visitor(lines, None, view=view)
+    visitor.visit_chunk(scope, chunk)
+    return visitor.nodes
+
+
 class Visitor:
     """The visitor visits the AST recursively to extract relevant name nodes in
     their context.
+
+    If `linenos` is given, only nodes in these lines are extracted. If `view`
+    is given as a line range (`start`, `stop`), nodes outside of it are
+    classified lazily.
     """
 
-    def __init__(self, lines, root_table):
+    def __init__(self, lines, root_table, linenos=None, view=None):
         self._lines = lines
         self._table_stack = [root_table]
-        self._env = []
-        # Holds a copy of the current environment to avoid repeated copying
+        # The innermost scope, shared by all nodes created in that scope
         self._cur_env = None
+        self._linenos = linenos
+        self._view = view
+        # Names of parameters registered as unused. Skipped or lazy nodes with
+        # these names may still need to mark them as used.
+        self._param_names = set()
         self.nodes = []
 
     def visit(self, node):
@@ -152,6 +209,16 @@ class Visitor:
         else:
             self._iter_node(node)
 
+    def visit_chunk(self, scope, chunk):
+        """Visit a chunk of top-level statements (see `module_chunks()`) in the
+        module `scope`."""
+        _, _, statements, tables = chunk
+        self._number_siblings(tables)
+        self._table_stack = list(reversed(tables))
+        self._cur_env = scope
+        for stmt in statements:
+            self.visit(stmt)
+
     @contextlib.contextmanager
     def _enter_scope(self):
         # Enter a local lexical variable scope (env represented by symtables).
@@ -161,30 +228,86 @@ class Visitor:
         # the order they appear ensures consistency with AST visitation.
         children = sorted(current_table.get_children(),
                           key=lambda st: st.get_lineno())
+        self._number_siblings(children)
         self._table_stack += reversed(children)
-        self._env.append(current_table)
-        self._cur_env = self._env[:]
+        parent = self._cur_env
+        self._cur_env = Scope(current_table, parent)
         yield current_table
-        self._env.pop()
-        self._cur_env = self._env[:]
+        self._cur_env = parent
+
+    @staticmethod
+    def _number_siblings(tables):
+        # Number the sibling symtables sharing their name and line (such as
+        # two lambdas), so their scopes can be told apart (see `Scope.key`).
+        # Unlike the columns of the nodes opening them, the numbers don't
+        # change when the code in their line is edited.
+        counts = Counter()
+        for table in tables:
+            key = (table.get_name(), table.get_lineno())
+            table.sibling_idx = counts[key]
+            counts[key] += 1
+
+    def _add_node(self,
+                  name,
+                  lineno,
+                  col,
+                  env,
+                  *,
+                  target=None,
+                  hl_group=None,
+                  lazy=True):
+        """Create a node and add it to the extracted nodes.
+
+        Returns None if the node is outside of the lines to visit. Unless
+        `lazy` is False, nodes outside of the view are classified lazily.
+        """
+        linenos = self._linenos
+        if linenos is not None and lineno not in linenos:
+            if name in self._param_names:
+                # Not extracted, but needs to mark the parameter as used
+                Node(name, lineno, col, env, target=target, hl_group=hl_group)
+            return None
+        view = self._view
+        if lazy and view is not None:
+            # Classifying a node which uses a parameter marks the parameter
+            # as used, so these can't be lazy.
+            lazy = not view[0] <= lineno <= view[1] and \
+                   name not in self._param_names
+        else:
+            lazy = False
+        node = Node(name,
+                    lineno,
+                    col,
+                    env,
+                    target=target,
+                    hl_group=hl_group,
+                    lazy=lazy)
+        self.nodes.append(node)
+        return node
 
     def _new_name(self, node):
-        self.nodes.append(Node(
+        self._add_node(
             node.id,
             node.lineno,
             node.col_offset,
             self._cur_env,
             # Using __dict__.get() is faster than getattr()
-            node.__dict__.get('_target'),
-        )) # yapf: disable
+            target=node.__dict__.get('_target'),
+        )
 
     def _visit_arg(self, node):
         """Visit function argument."""
-        node = Node(node.arg, node.lineno, node.col_offset, self._cur_env)
-        self.nodes.append(node)
+        node = self._add_node(node.arg,
+                              node.lineno,
+                              node.col_offset,
+                              self._cur_env,
+                              lazy=False)
+        if node is None:
+            return
         # Register as unused parameter for now. The entry is removed if it's
         # found to be used later.
-        self._env[-1].unused_params[node.name] = node
+        self._cur_env.table.unused_params[node.name] = node
+        self._param_names.add(node.name)
 
     def _visit_arg_defaults(self, node):
         """Visit argument default values."""
@@ -221,12 +344,12 @@ class Visitor:
         token = advance(tokens)
         lineno = token.start[0] + line_idx
         cur_line = self._lines[lineno - 1]
-        self.nodes.append(Node(
+        self._add_node(
             node.name,
             lineno,
             len(cur_line[:token.start[1]].encode('utf-8')),
             self._cur_env,
-        ))  # yapf: disable
+        )
 
     def _visit_comp(self, node):
         """Visit set/dict/list comprehension or generator expression."""
@@ -284,14 +407,13 @@ class Visitor:
                 guess = 'from ' + (node.module or node.level * '.') + ' ' + \
                         guess
             if self._lines[line_idx] == guess:
-                self.nodes.append(Node(
+                self._add_node(
                     target,
                     node.lineno,
                     len(guess.encode('utf-8')) - len(target.encode('utf-8')),
                     self._cur_env,
-                    None,
-                    IMPORTED,
-                ))  # yapf: disable
+                    hl_group=IMPORTED,
+                )
                 return
         # Guessing the line failed, so we need to use the tokenizer
         tokens = tokenize_lines(self._lines[i] for i in count(line_idx))
@@ -314,15 +436,14 @@ class Visitor:
                 advance(tokens, 'as')
             token = advance(tokens)
             cur_line = self._lines[line_idx + token.start[0] - 1]
-            self.nodes.append(Node(
+            self._add_node(
                 token.string,
                 token.start[0] + line_idx,
                 # Exact byte offset of the token
                 len(cur_line[:token.start[1]].encode('utf-8')),
                 self._cur_env,
-                None,
-                IMPORTED,
-            ))  # yapf: disable
+                hl_group=IMPORTED,
+            )
 
             # If there are more imports in that import statement...
             if more:
@@ -355,7 +476,7 @@ class Visitor:
             token = advance(tokens)
             lineno = token.start[0] + line_idx
             column = token.start[1]
-        self.nodes.append(Node(node.name, lineno, column, self._cur_env))
+        self._add_node(node.name, lineno, column, self._cur_env)
 
         # Handling type parameters & generic syntax (Python 3.12+)
         # When generic type vars are present, a new scope is added
@@ -381,12 +502,12 @@ class Visitor:
         if line == indent + keyword + ' ' + ', '.join(node.names):
             offset = len(indent) + len(keyword) + 1
             for name in node.names:
-                self.nodes.append(Node(
+                self._add_node(
                     name,
                     node.lineno,
                     offset,
                     self._cur_env,
-                )) # yapf: disable
+                )
                 # Add 2 bytes for the comma and space
                 offset += len(name.encode('utf-8')) + 2
             return
@@ -397,12 +518,12 @@ class Visitor:
         for name, more in zip(node.names, count(1 - len(node.names))):
             token = advance(tokens)
             cur_line = self._lines[line_idx + token.start[0] - 1]
-            self.nodes.append(Node(
+            self._add_node(
                 token.string,
                 token.start[0] + line_idx,
                 len(cur_line[:token.start[1]].encode('utf-8')),
                 self._cur_env,
-            )) # yapf: disable
+            )
             # If there are more declared names...
             if more:
                 # ...advance to next comma.
@@ -428,13 +549,12 @@ class Visitor:
 
     def _visit_typevar(self, node):
         # node: ast.TypeVar | ast.ParamSpec | ast.TypeVarTuple
-        self.nodes.append(
-            Node(
-                node.name,
-                node.lineno,
-                node.col_offset,
-                self._cur_env,
-            ))
+        self._add_node(
+            node.name,
+            node.lineno,
+            node.col_offset,
+            self._cur_env,
+        )
 
         # When a TypeVar has a bound or a default value,
         # e.g. `T: T_Bound = T_Default`, each expression (bound and/or default)
@@ -457,6 +577,8 @@ class Visitor:
         method called "self" or "cls") and add a reference in the function's
         symtable.
         """
+        # The symtable may have been visited before, so reset the self_param
+        self._table_stack[-1].self_param = None
         # The first argument...
         try:
             # TODO Does this break with posonlyargs?
@@ -467,7 +589,7 @@ class Visitor:
         if arg.arg not in ('self', 'cls'):
             return
         # ...and a class as parent scope is a self_param.
-        if not self._env[-1].get_type() == 'class':
+        if not self._cur_env.table.get_type() == 'class':
             return
         # Let the table for the current function scope remember the param
         self._table_stack[-1].self_param = arg.arg
@@ -486,18 +608,16 @@ class Visitor:
         if target_name not in ('self', 'cls'):
             return
         # Only register attributes of self/cls parameter
-        if target_name != getattr(self._env[-1], 'self_param', None):
+        if target_name != getattr(self._cur_env.table, 'self_param', None):
             return
-        new_node = Node(
+        new_node = self._add_node(
             node.attr,
             node.value.lineno,
             node.value.col_offset + len(target_name) + 1,
-            self._env[:-1],
-            None,  # target
-            ATTRIBUTE,
+            self._cur_env.parent,
+            hl_group=ATTRIBUTE,
         )
         node.value._target = new_node  # pylint: disable=protected-access
-        self.nodes.append(new_node)
 
     def _iter_node(self, node):
         """Iterate through fields of the node."""
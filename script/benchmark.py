@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""Benchmark the parser on the grammar test files and synthetic modules.
+
+Usage (from the repository root):
+
+    python script/benchmark.py [-o results.json] [-c baseline.json]
+
+Results are written as JSON, so the results of two revisions can be compared
+with --compare.
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+import warnings
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# pylint: disable=wrong-import-position,protected-access
+from semshi.handler import nodes_to_hl  # noqa: E402
+from semshi.parser import Parser, UnparsableError  # noqa: E402
+
+SYNTHETIC_TEMPLATE = '''\
+import os.path
+from collections import defaultdict as dd{i}
+
+
+class Class{i}(object):
+    """Docstring of class {i}."""
+    attr = {i}
+
+    def __init__(self, a, b=None, *args, **kwargs):
+        self.a = a
+        self.b = b or dd{i}(list)
+        self.items = [x * a for x in range({i}) if x % 2]
+
+    def method(self, value):
+        total = 0
+        for key, item in self.b.items():
+            total += len(item) + value
+        return os.path.join(str(total), self.attr)
+
+
+def function{i}(param, unused):
+    local = Class{i}(param)
+
+    def closure():
+        nonlocal local
+        return local.method(param)
+
+    return closure() + global_{i}
+
+
+global_{i} = {{k: v for k, v in enumerate(range({i}))}}
+lam{i} = lambda x, y=global_{i}: x + len(y)
+'''
+
+PASTE = '''\
+def pasted(arg):
+    result = [arg for _ in range(10)]
+    return sorted(result, key=lambda x: -x)
+'''
+
+
+def synthetic_code(num_lines):
+    """Return a module with about `num_lines` lines."""
+    chunks = []
+    lines = 0
+    i = 0
+    while lines < num_lines:
+        chunk = SYNTHETIC_TEMPLATE.format(i=i)
+        chunks.append(chunk)
+        lines += chunk.count('\n')
+        i += 1
+    return ''.join(chunks)
+
+
+def measure(func, repeat):
+    """Call `func` `repeat` times and return timing statistics in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {
+        'min': min(times),
+        'median': statistics.median(times),
+        'max': max(times),
+        'runs': repeat,
+    }
+
+
+def bench_code(code, repeat, rng):
+    """Run all benchmarks on `code` and return a dict of results."""
+    lines = code.split('\n')
+    results = {}
+
+    results['parse_cold'] = measure(lambda: Parser().parse(code), repeat)
+
+    parser = Parser()
+    parser.parse(code)
+    results['parse_unchanged'] = measure(lambda: parser.parse(code), repeat)
+    results['parse_force'] = measure(lambda: parser.parse(code, force=True),
+                                     repeat)
+
+    nodes = list(parser._nodes)
+    if not nodes:
+        return results
+
+    # Insert a character into a random name and revert the edit again, as
+    # if the user was typing.
+    def minor_edit():
+        node = rng.choice(nodes)
+        line = lines[node.lineno - 1]
+        edited = lines[:]
+        edited[node.lineno - 1] = line[:node.col] + 'x' + line[node.col:]
+        for new_lines in (edited, lines):
+            try:
+                parser.parse('\n'.join(new_lines))
+            except UnparsableError:
+                pass
+
+    results['minor_edit'] = measure(minor_edit, repeat)
+
+    # Paste a multi-line block in front of a random top-level statement and
+    # remove it again.
+    starts = sorted({n.lineno for n in nodes if n.env.parent is None})
+
+    def paste():
+        lineno = rng.choice(starts)
+        if lines[lineno - 1][:1].isspace():
+            return
+        pasted = lines[:lineno - 1] + PASTE.split('\n') + lines[lineno - 1:]
+        for new_lines in (pasted, lines):
+            try:
+                parser.parse('\n'.join(new_lines))
+            except UnparsableError:
+                pass
+
+    results['paste'] = measure(paste, repeat)
+
+    nodes = list(parser._nodes)
+    cursors = [(n.lineno, n.col)
+               for n in rng.sample(nodes, min(100, len(nodes)))]
+    results['node_at'] = measure(
+        lambda: [parser.node_at(cursor) for cursor in cursors], repeat)
+    results['same_nodes'] = measure(
+        lambda: [list(parser.same_nodes(cursor)) for cursor in cursors[:10]],
+        repeat)
+    results['nodes_to_hl'] = measure(lambda: nodes_to_hl(nodes), repeat)
+    results['nodes'] = len(nodes)
+    results['lines'] = len(lines)
+    return results
+
+
+def collect_sources(sizes):
+    """Return a dict of source names to code."""
+    sources = {}
+    for path in sorted((ROOT / 'test' / 'data').glob('grammar*.py')):
+        code = path.read_text(encoding='utf-8')
+        try:
+            Parser(fix_syntax=False).parse(code)
+        except UnparsableError:
+            # Grammar of a different Python version
+            continue
+        sources[path.name] = code
+    for size in sizes:
+        sources['synthetic%dk' % (size // 1000)] = synthetic_code(size)
+    return sources
+
+
+def compare(results, baseline):
+    """Print the change of median times relative to `baseline`."""
+    for source, benches in results['results'].items():
+        old_benches = baseline['results'].get(source, {})
+        for name, result in benches.items():
+            old = old_benches.get(name)
+            if not isinstance(result, dict) or not isinstance(old, dict):
+                continue
+            ratio = result['median'] / old['median'] if old['median'] else 0
+            print('%-20s %-16s %10.3fms -> %10.3fms  (%.2fx)' %
+                  (source, name, old['median'] * 1000, result['median'] * 1000,
+                   ratio))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    arg_parser.add_argument('-o', '--output', help='file to write results to')
+    arg_parser.add_argument('-c', '--compare', help='results to compare to')
+    arg_parser.add_argument('-r', '--repeat', type=int, default=3)
+    arg_parser.add_argument('--sizes',
+                            type=int,
+                            nargs='*',
+                            default=[10000, 50000],
+                            help='line counts of synthetic modules')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    # Deep ASTs of the grammar files exceed the default recursion limit
+    sys.setrecursionlimit(10000)
+    # The grammar files provoke lots of warnings when compiled
+    warnings.simplefilter('ignore', SyntaxWarning)
+    rng = random.Random(args.seed)
+    results = {
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': {},
+    }
+    for source, code in collect_sources(args.sizes).items():
+        print('%s...' % source, file=sys.stderr)
+        results['results'][source] = bench_code(code, args.repeat, rng)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
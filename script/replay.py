@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Replay an editing session on a buffer handler without Neovim.
+
+Usage (from the repository root):
+
+    python script/replay.py TRACE [-o results.json] [--lua]
+    python script/replay.py FILE.py [-o results.json] [--lua]
+
+TRACE is a trace file as described in semshi/trace.py, which is recorded by
+setting $SEMSHI_TRACE_DIR. Given a Python file instead, a session of typing a
+new line into the middle of the file is replayed. Reports the latency per
+event type, the number and size of the RPC calls the handler made, and the
+timing metrics of internal operations. With --lua, highlights are added with
+the Lua helper (see g:semshi#lua_highlights).
+"""
+import argparse
+import json
+import statistics
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# pylint: disable=wrong-import-position
+from semshi.fakevim import replay  # noqa: E402
+from semshi.trace import read_trace  # noqa: E402
+from semshi.util import metrics  # noqa: E402
+
+TYPED_LINE = 'result = compute(value, key=lambda item: item.name)'
+
+
+def typing_trace(path):
+    """Return tuple (`buffer`, `events`) of a session typing a line into the
+    middle of the file `path` and scrolling through the file afterwards."""
+    lines = Path(path).read_text(encoding='utf-8').split('\n')
+    # Insert at a top-level line, so the indentation is valid
+    idx = next((i for i in range(len(lines) // 2, len(lines))
+                if lines[i] and not lines[i][0].isspace()), len(lines))
+    view = (max(idx - 20, 1), idx + 20)
+    events = [
+        {
+            'event': 'viewport',
+            'start': view[0],
+            'stop': view[1]
+        },
+        {
+            'event': 'edit',
+            'start': idx,
+            'end': idx,
+            'lines': ['']
+        },
+    ]
+    for i in range(1, len(TYPED_LINE) + 1):
+        events.append({'event': 'cursor', 'cursor': [idx + 1, i]})
+        events.append({
+            'event': 'edit',
+            'start': idx,
+            'end': idx + 1,
+            'lines': [TYPED_LINE[:i]],
+        })
+    for start in range(1, len(lines), 40):
+        events.append({
+            'event': 'viewport',
+            'start': start,
+            'stop': start + 40
+        })
+        events.append({'event': 'cursor', 'cursor': [start, 0]})
+    return {'lines': lines, 'name': str(path)}, events
+
+
+def summarize(latencies):
+    summary = {}
+    for type_, times in latencies.items():
+        times = sorted(times)
+        summary[type_] = {
+            'count': len(times),
+            'median': statistics.median(times),
+            'p95': times[int(.95 * (len(times) - 1))],
+            'max': times[-1],
+            'total': sum(times),
+        }
+    return summary
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    arg_parser.add_argument('trace', help='trace file or Python file')
+    arg_parser.add_argument('-o', '--output', help='file to write results to')
+    arg_parser.add_argument('--lua',
+                            action='store_true',
+                            help='highlight with the Lua helper')
+    args = arg_parser.parse_args()
+
+    sys.setrecursionlimit(10000)
+    if args.trace.endswith('.py'):
+        buffer, events = typing_trace(args.trace)
+    else:
+        buffer, events = read_trace(args.trace)
+    metrics.enabled = True
+    variables = {
+        'semshi#error_sign': False,
+        'semshi#idle_paint_delay': 0,
+        'semshi#lua_highlights': args.lua,
+    }
+    vim, latencies = replay(buffer, events, variables)
+    results = {
+        'events': summarize(latencies),
+        'rpc': dict(vim.stats),
+        'metrics': metrics.summary(),
+    }
+    for type_, stats in results['events'].items():
+        print('%-10s %5d events  median %8.3fms  p95 %8.3fms  max %8.3fms' %
+              (type_, stats['count'], stats['median'] * 1000,
+               stats['p95'] * 1000, stats['max'] * 1000),
+              file=sys.stderr)
+    print('rpc: %s' % ', '.join('%s=%d' % item
+                                for item in sorted(vim.stats.items())),
+          file=sys.stderr)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -61,7 +61,7 @@ def parse(code):
     add, remove = Parser().parse(dedent(code))
     assert len(remove) == 0
     for node in add:
-        node.base_table()
+        node.base_scope
     return add
 
 
@@ -0,0 +1,67 @@
+import os
+import sys
+
+from semshi.cache import HighlightCache
+from semshi.node import GLOBAL, IMPORTED
+
+
+def make_node(lineno, col, name, hl_group):
+    return (lineno, col, col + len(name), hl_group)
+
+
+def test_store_load(tmp_path):
+    cache = HighlightCache(str(tmp_path / 'cache'))
+    code = 'import os\nx = os'
+    nodes = [
+        make_node(1, 7, 'os', IMPORTED),
+        make_node(2, 0, 'x', GLOBAL),
+        make_node(2, 4, 'os', IMPORTED),
+    ]
+    assert cache.load('/foo.py', code) is None
+    cache.store('/foo.py', code, nodes)
+    assert cache.load('/foo.py', code) == [
+        (1, 7, 9, IMPORTED),
+        (2, 0, 1, GLOBAL),
+        (2, 4, 6, IMPORTED),
+    ]
+    # Entries are only valid for the same path and content
+    assert cache.load('/bar.py', code) is None
+    assert cache.load('/foo.py', code + '\n') is None
+    # A new entry replaces the old one
+    cache.store('/foo.py', 'y', [make_node(1, 0, 'y', GLOBAL)])
+    assert cache.load('/foo.py', code) is None
+    assert cache.load('/foo.py', 'y') == [(1, 0, 1, GLOBAL)]
+
+
+def test_python_version(tmp_path, monkeypatch):
+    cache = HighlightCache(str(tmp_path))
+    cache.store('/foo.py', 'x', [make_node(1, 0, 'x', GLOBAL)])
+    monkeypatch.setattr(sys, 'version_info', (2, 7, 18))
+    assert cache.load('/foo.py', 'x') is None
+
+
+def test_invalid_entry(tmp_path):
+    cache = HighlightCache(str(tmp_path))
+    cache.store('/foo.py', 'x', [make_node(1, 0, 'x', GLOBAL)])
+    for entry in tmp_path.iterdir():
+        entry.write_text('{"path": "/foo.py"')
+    assert cache.load('/foo.py', 'x') is None
+    for entry in tmp_path.iterdir():
+        entry.write_text('{"path": "/foo.py"}')
+    assert cache.load('/foo.py', 'x') is None
+
+
+def test_prune(tmp_path):
+    """The least recently used entries beyond the maximum are removed."""
+    cache = HighlightCache(str(tmp_path), max_entries=2)
+    nodes = [make_node(1, 0, 'x', GLOBAL)]
+    for i, path in enumerate(['/a.py', '/b.py']):
+        cache.store(path, 'x', nodes)
+        os.utime(cache._entry_path(path), (i, i))
+    # Loading marks an entry as recently used
+    assert cache.load('/a.py', 'x') == [(1, 0, 1, GLOBAL)]
+    cache.store('/c.py', 'x', nodes)
+    assert len(list(tmp_path.iterdir())) == 2
+    assert cache.has_entry('/a.py')
+    assert not cache.has_entry('/b.py')
+    assert cache.has_entry('/c.py')
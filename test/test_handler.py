@@ -0,0 +1,663 @@
+"""Unit Tests for semshi.handler"""
+
+import pstats
+import threading
+import time
+import tracemalloc
+
+from semshi.fakevim import FakeBuffer, FakeNvim, replay
+from semshi.handler import CACHE_HL_ID, BufferHandler
+from semshi.node import BUILTIN, GLOBAL, SELECTED, UNRESOLVED
+from semshi.plugin import Options, Plugin
+from semshi.trace import TraceRecorder, read_trace
+
+VARIABLES = {'semshi#error_sign': False, 'semshi#idle_paint_delay': 0}
+
+
+def make_handler(lines, **variables):
+    variables = {'semshi#' + k: v for k, v in variables.items()}
+    vim = FakeNvim(lines, variables={**VARIABLES, **variables})
+    handler = BufferHandler(vim.current.buffer, vim, Options(vim))
+    return vim, handler
+
+
+def highlighted_lines(vim):
+    return {hl[1] for hl in vim.current.buffer.visible_highlights()}
+
+
+def be_idle(handler):
+    """Let the idle timer of `handler` fire as if the user had been idle for
+    the idle paint delay, and wait for the painting to finish."""
+    # pylint: disable=protected-access
+    handler._idle_timer.cancel()
+    handler._last_input -= handler._options.idle_paint_delay
+    handler._check_idle()
+    handler._update_thread.join()
+
+
+def test_visible_highlights():
+    vim, handler = make_handler(['a%d = len' % i for i in range(100)])
+    handler.viewport(1, 10)
+    handler.update(force=True, sync=True)
+    # The viewport is extended by its height in both directions
+    assert highlighted_lines(vim) == set(range(19))
+    handler.viewport(51, 60)
+    assert highlighted_lines(vim) == set(range(19)) | set(range(41, 69))
+
+
+def test_viewport_lookahead():
+    """Highlights are added ahead of time in the direction of scrolling."""
+    vim, handler = make_handler(['a%d = len' % i for i in range(200)])
+    handler.viewport(1, 10)
+    handler.update(force=True, sync=True)
+    calls = vim.stats['call_atomic']
+    for start in range(2, 42):
+        handler.viewport(start, start + 9)
+        assert set(range(start - 1, start + 9)) <= highlighted_lines(vim)
+    assert vim.stats['call_atomic'] - calls == 3
+    # Lines further ahead than behind are highlighted
+    assert highlighted_lines(vim) == set(range(64))
+    handler.viewport(31, 40)
+    assert vim.stats['call_atomic'] - calls == 3
+    # Jumping centers the view around the viewport again
+    handler.viewport(151, 160)
+    assert set(range(141, 169)) <= highlighted_lines(vim)
+    assert 169 not in highlighted_lines(vim)
+
+
+def test_windows():
+    """Highlights are added in the views of all windows showing the
+    buffer."""
+    vim, handler = make_handler(['a%d = len' % i for i in range(200)])
+    handler.viewport(1, 10, 1000)
+    handler.viewport(101, 110, 1001)
+    handler.update(force=True, sync=True)
+    assert highlighted_lines(vim) == set(range(19)) | set(range(91, 119))
+    # Scrolling one window doesn't move the view of the other one
+    handler.viewport(131, 140, 1001)
+    handler.viewport(1, 10, 1000)
+    assert highlighted_lines(vim) == \
+        set(range(19)) | set(range(91, 119)) | set(range(121, 149))
+    vim.current.buffer[5] = 'a5 = foo'
+    vim.current.buffer[135] = 'a135 = foo'
+    handler.update(sync=True)
+    assert {(UNRESOLVED, 5, 5, 8), (UNRESOLVED, 135, 7, 10)} <= \
+        vim.current.buffer.visible_highlights()
+    handler.remove_viewport(1001)
+    vim.current.buffer[136] = 'a136 = foo'
+    handler.update(sync=True)
+    assert (UNRESOLVED, 136, 7, 10) not in \
+        vim.current.buffer.visible_highlights()
+
+
+def test_idle_paint():
+    """The highlights outside of the view are added once the user is
+    idle."""
+    # pylint: disable=protected-access
+    # The timer doesn't fire during the test, but is checked by be_idle()
+    vim, handler = make_handler(['a%d = len' % i for i in range(200)],
+                                idle_paint_delay=60,
+                                mark_selected_nodes=0)
+    handler.viewport(1, 10)
+    handler.update(force=True, sync=True)
+    assert highlighted_lines(vim) == set(range(19))
+    timer = handler._idle_timer
+    # Input doesn't restart the timer...
+    handler.viewport(2, 11)
+    assert handler._idle_timer is timer
+    # ...but delays painting, so the timer is re-armed when it fires
+    timer.cancel()
+    handler._check_idle()
+    assert handler._idle_timer not in (None, timer)
+    assert highlighted_lines(vim) == set(range(19))
+    be_idle(handler)
+    assert highlighted_lines(vim) == set(range(200))
+    calls = vim.stats['calls']
+    handler.viewport(151, 160)
+    assert vim.stats['calls'] == calls
+    # Nothing left to paint, so there's no need for a timer
+    assert handler._idle_timer is None
+    vim.current.buffer.set_lines(0, 1, ['a0 = foo'])
+    handler.update(sync=True)
+    vim.current.buffer.set_lines(0, 0, ['b = len'] * 200)
+    handler.update(sync=True)
+    assert handler._pending_nodes
+    be_idle(handler)
+    assert not handler._pending_nodes
+    expected_vim, expected = make_handler(vim.current.buffer.lines,
+                                          mark_selected_nodes=0)
+    expected.viewport(1, 400)
+    expected.update(force=True, sync=True)
+    assert vim.current.buffer.visible_highlights() == \
+        expected_vim.current.buffer.visible_highlights()
+
+
+def test_release_symtables():
+    """The symtables are kept until the lazy nodes outside of the view are
+    classified by painting them."""
+    lines = []
+    for i in range(100):
+        lines += ['def f%d(a):' % i, '    x = a', '    return x']
+    _, handler = make_handler(lines,
+                              idle_paint_delay=60,
+                              mark_selected_nodes=0)
+    handler.viewport(1, 10)
+    handler.update(force=True, sync=True)
+    # pylint: disable=protected-access
+    nodes = handler._parser._nodes
+    assert any(node.lazy for node in nodes)
+    assert nodes[-1].env.table is not None
+    be_idle(handler)
+    assert not any(node.lazy for node in nodes)
+    assert all(node.env.table is None for node in nodes)
+
+
+def test_cache(tmp_path):
+    """Highlights are cached once they have all been classified, and painted
+    from the cache until the buffer has been parsed."""
+    # pylint: disable=protected-access
+    lines = []
+    for i in range(100):
+        lines += ['def f%d(a):' % i, '    x = a', '    return x']
+    variables = {
+        **VARIABLES,
+        'semshi#cache_dir': str(tmp_path),
+        'semshi#idle_paint_delay': 60,
+    }
+    vim = FakeNvim(lines, '/foo.py', variables)
+    handler = BufferHandler(vim.current.buffer, vim, Options(vim))
+    stored = threading.Event()
+    store = handler._cache.store
+
+    def store_and_notify(*args):
+        store(*args)
+        stored.set()
+
+    handler._cache.store = store_and_notify
+    handler.viewport(1, 10)
+    handler.update(force=True, sync=True)
+    # The lazy nodes outside of the view haven't been classified yet
+    assert not stored.is_set()
+    be_idle(handler)
+    assert stored.wait(5)
+
+    vim = FakeNvim(lines, '/foo.py', variables)
+    handler = BufferHandler(vim.current.buffer, vim, Options(vim))
+    handler.viewport(1, 10)
+    handler._cache_checked = True
+    handler._load_cache_entry('/foo.py', lines)
+    assert vim.current.buffer.highlights[CACHE_HL_ID]
+    handler.update(force=True, sync=True)
+    assert not vim.current.buffer.highlights[CACHE_HL_ID]
+    visible = vim.current.buffer.visible_highlights()
+    expected_vim, expected_handler = make_handler(lines)
+    expected_handler.viewport(1, 10)
+    expected_handler.update(force=True, sync=True)
+    assert visible == expected_vim.current.buffer.visible_highlights()
+    # Cached highlights loaded after parsing aren't painted anymore
+    handler._load_cache_entry('/foo.py', lines)
+    assert not vim.current.buffer.highlights[CACHE_HL_ID]
+
+
+def test_update():
+    vim, handler = make_handler(['a%d = len' % i for i in range(10)])
+    handler.viewport(1, 10)
+    handler.update(force=True, sync=True)
+    hls = vim.current.buffer.visible_highlights()
+    assert (BUILTIN, 4, 5, 8) in hls
+    assert {hl[0] for hl in hls} == {GLOBAL, BUILTIN}
+    vim.current.buffer[4] = 'a4 = foo'
+    calls = vim.stats['call_atomic']
+    handler.update(sync=True)
+    hls = vim.current.buffer.visible_highlights()
+    assert (BUILTIN, 4, 5, 8) not in hls
+    assert (UNRESOLVED, 4, 5, 8) in hls
+    assert len(hls) == 20
+    # One call to add and one to clear a highlight
+    assert vim.stats['call_atomic'] - calls == 2
+
+
+def test_lua_highlights():
+    lines = ['a%d = len' % i for i in range(100)]
+    handlers = [
+        make_handler(lines),
+        make_handler(lines, lua_highlights=True),
+    ]
+    for _, handler in handlers:
+        handler.viewport(1, 10)
+        handler.update(force=True, sync=True)
+        handler.mark_selected((1, 6))
+    (vim, _), (lua_vim, _) = handlers
+    hls = vim.current.buffer.visible_highlights()
+    assert lua_vim.current.buffer.visible_highlights() == hls
+    assert lua_vim.stats['bytes'] < vim.stats['bytes'] / 2
+    for vim_, handler in handlers:
+        vim_.current.buffer[4] = 'a4 = foo'
+        handler.update(sync=True)
+        handler.mark_selected((2, 6))
+    hls = vim.current.buffer.visible_highlights()
+    assert (UNRESOLVED, 4, 5, 8) in hls
+    assert (SELECTED, 0, 5, 8) in hls
+    assert lua_vim.current.buffer.visible_highlights() == hls
+
+
+def test_mark_selected():
+    """Only the marks of nodes that are (de)selected are updated."""
+    lines = ['a = 1'] + ['b = a' if i % 2 else 'a = a' for i in range(100)]
+
+    def marks(vim):
+        return {
+            hl[1:]
+            for hl in vim.current.buffer.visible_highlights()
+            if hl[0] == SELECTED
+        }
+
+    for lua in [False, True]:
+        # Without lookahead, the marks are in the viewport only
+        vim, handler = make_handler(lines,
+                                    lua_highlights=lua,
+                                    mark_selected_nodes=2,
+                                    viewport_lookahead=0)
+        handler.viewport(1, 20)
+        handler.update(force=True, sync=True)
+        handler.mark_selected((1, 0))
+        assert len(marks(vim)) == 30
+        bytes_ = vim.stats['bytes']
+        handler.mark_selected((2, 4))
+        assert vim.stats['bytes'] == bytes_
+        # Only the marks of the lines scrolled in and out of view are updated
+        handler.viewport(2, 21)
+        bytes_ = vim.stats['bytes']
+        handler.mark_selected((2, 4))
+        assert vim.stats['bytes'] - bytes_ < 200
+        assert len(marks(vim)) == 30
+        assert (0, 0, 1) not in marks(vim)
+        assert (20, 4, 5) in marks(vim)
+        handler.mark_selected((3, 0))
+        assert len(marks(vim)) == 10
+
+
+def test_reset_highlights():
+    """Pasting lots of lines clears all highlights at once and only adds the
+    visible ones again."""
+    lines = ['a%d = len' % i for i in range(2000)]
+    vim, handler = make_handler(lines, lua_highlights=True)
+    handler.viewport(1, 2000)
+    handler.update(force=True, sync=True)
+    handler.viewport(1, 10)
+    bytes_ = vim.stats['bytes']
+    # The first line changed, so the nodes can't be matched by shifting them
+    vim.current.buffer.set_lines(0, 1, ['b%d = a1' % i
+                                        for i in range(500)] + ['a0 = 1'])
+    handler.update(sync=True)
+    assert vim.stats['bytes'] - bytes_ < 2000
+    expected_vim, expected = make_handler(vim.current.buffer.lines)
+    expected.viewport(1, 10)
+    expected.update(force=True, sync=True)
+    assert vim.current.buffer.visible_highlights() == \
+        expected_vim.current.buffer.visible_highlights()
+
+
+def test_line_shift():
+    """Nodes of shifted lines keep their highlights."""
+    lines = ['a%d = %s' % (i, 'len' if i % 2 else 1) for i in range(100)]
+    vim, handler = make_handler(lines)
+    handler.viewport(1, 20)
+    handler.update(force=True, sync=True)
+    calls = vim.stats['calls']
+    vim.current.buffer.set_lines(5, 5, ['b = len', 'c = 1'])
+    handler.update(sync=True)
+    # Only the new nodes in the viewport are added
+    assert vim.stats['calls'] - calls == 3
+    vim.current.buffer.set_lines(10, 11, [])
+    handler.update(sync=True)
+    handler.viewport(51, 70)
+    expected_vim, expected = make_handler(vim.current.buffer.lines)
+    expected.viewport(1, 20)
+    expected.update(force=True, sync=True)
+    expected.viewport(51, 70)
+    assert vim.current.buffer.visible_highlights() == \
+        expected_vim.current.buffer.visible_highlights()
+
+
+def test_replay():
+    """Highlights after replaying edits are the same as after highlighting
+    the final code from scratch."""
+    lines = ['def f(a):', '    return a', 'x = f', '']
+    typed = 'y = f(x) + a'
+    events = [
+        {
+            'event': 'viewport',
+            'start': 1,
+            'stop': 10
+        },
+        {
+            'event': 'edit',
+            'start': 3,
+            'end': 3,
+            'lines': ['']
+        },
+    ]
+    for i in range(1, len(typed) + 1):
+        events.append({
+            'event': 'edit',
+            'start': 3,
+            'end': 4,
+            'lines': [typed[:i]],
+        })
+        events.append({'event': 'cursor', 'cursor': [4, i]})
+    vim, latencies = replay({'lines': lines}, events, VARIABLES)
+    assert len(latencies['edit']) == len(typed) + 1
+    assert vim.stats['calls'] > 0
+
+    expected_vim, handler = make_handler(vim.current.buffer.lines)
+    handler.viewport(1, 10)
+    expected_vim.current.window.cursor = (4, len(typed))
+    handler.update(force=True, sync=True)
+    assert vim.current.buffer.visible_highlights() == \
+        expected_vim.current.buffer.visible_highlights()
+
+
+def test_trace(tmp_path, monkeypatch):
+    """A recorded trace reproduces the session."""
+    monkeypatch.setenv('SEMSHI_TRACE_DIR', str(tmp_path))
+    lines = ['x = 1', 'y = 2', 'z = 3']
+    events = [
+        {
+            'event': 'viewport',
+            'start': 2,
+            'stop': 3,
+            'window': 1000
+        },
+        {
+            'event': 'viewport',
+            'start': 1,
+            'stop': 2,
+            'window': 1001
+        },
+        {
+            'event': 'remove_viewport',
+            'window': 1001
+        },
+        {
+            'event': 'edit',
+            'start': 1,
+            'end': 2,
+            'lines': ['y = x', 'w = y']
+        },
+        {
+            'event': 'cursor',
+            'cursor': [2, 4]
+        },
+        {
+            'event': 'edit',
+            'start': 3,
+            'end': 4,
+            'lines': []
+        },
+    ]
+    vim, _ = replay({'lines': lines, 'name': 'foo.py'}, events, VARIABLES)
+    monkeypatch.delenv('SEMSHI_TRACE_DIR')
+    path, = tmp_path.iterdir()
+    buffer, recorded = read_trace(str(path))
+    assert buffer == {'lines': lines, 'name': 'foo.py'}
+    assert [{
+        k: v
+        for k, v in e.items() if k != 'time'
+    } for e in recorded] == [
+        {
+            'event': 'viewport',
+            'start': 1,
+            'stop': 50,
+            'window': 0
+        },
+        {
+            'event': 'cursor',
+            'cursor': [1, 0]
+        },
+        {
+            'event': 'viewport',
+            'start': 2,
+            'stop': 3,
+            'window': 1000
+        },
+        {
+            'event': 'viewport',
+            'start': 1,
+            'stop': 2,
+            'window': 1001
+        },
+        {
+            'event': 'remove_viewport',
+            'window': 1001
+        },
+        {
+            'event': 'edit',
+            'start': 1,
+            'end': 2,
+            'lines': ['y = x', 'w = y']
+        },
+        {
+            'event': 'cursor',
+            'cursor': [2, 4]
+        },
+        {
+            'event': 'edit',
+            'start': 3,
+            'end': 4,
+            'lines': []
+        },
+    ]
+    replayed_vim, _ = replay(buffer, recorded, VARIABLES)
+    assert replayed_vim.current.buffer.lines == vim.current.buffer.lines
+    assert replayed_vim.current.buffer.visible_highlights() == \
+        vim.current.buffer.visible_highlights()
+
+
+def test_trace_concurrent_events(tmp_path):
+    """Events recorded by another thread while the initial buffer is recorded
+    never precede it."""
+    path = str(tmp_path / 'trace.jsonl')
+    recorder = TraceRecorder(path)
+    done = threading.Event()
+
+    def record_viewports():
+        while not done.is_set():
+            recorder.viewport(1, 10)
+
+    thread = threading.Thread(target=record_viewports)
+    thread.start()
+    try:
+        recorder.lines(['x = 1'])
+    finally:
+        done.set()
+        thread.join()
+    recorder.close()
+    buffer, events = read_trace(path)
+    assert buffer == {'lines': ['x = 1'], 'name': ''}
+    assert all(e['event'] == 'viewport' for e in events)
+
+
+def test_trace_shutdown(tmp_path, monkeypatch):
+    """Shutting down the handler closes the trace."""
+    monkeypatch.setenv('SEMSHI_TRACE_DIR', str(tmp_path))
+    _, handler = make_handler(['x = 1'])
+    handler.viewport(1, 10)
+    handler.update(force=True, sync=True)
+    handler.shutdown()
+    handler.viewport(2, 10)
+    path, = tmp_path.iterdir()
+    _, recorded = read_trace(str(path))
+    assert [e['event'] for e in recorded] == ['viewport', 'cursor']
+    assert handler._trace._file is None  # pylint: disable=protected-access
+
+
+def test_update_stats():
+    vim, handler = make_handler(['import os', 'x = os.path'])
+    handler.viewport(1, 10)
+    handler.update(force=True, sync=True)
+    vim.current.buffer[1] = 'x = (os'
+    handler.update(sync=True)
+    vim.current.buffer.lines = ['x = (', 'y = ]']
+    handler.update(sync=True)
+    first, fixed, error = handler.update_stats
+    assert (first['add'], first['rem'], first['nodes']) == (3, 0, 3)
+    assert {'fetch', 'ast', 'symtable', 'visit', 'highlight', 'total'} <= \
+        set(first['timings'])
+    assert 'fix' not in first['timings']
+    assert fixed['timings']['fix'] > 0
+    assert not fixed['error']
+    assert error['error']
+
+
+def test_profile(tmp_path):
+    vim, handler = make_handler(['import os', 'x = os.path'])
+    assert handler.start_profile(memory=True)
+    # Starting again doesn't replace the running profile
+    assert not handler.start_profile()
+    handler.update(force=True, sync=True)
+    path = str(tmp_path / 'profile')
+    assert handler.stop_profile(path) == [path, path + '.tracemalloc']
+    stats = pstats.Stats(path)
+    assert any(func[2] == '_update_step' for func in stats.stats)
+    tracemalloc.Snapshot.load(path + '.tracemalloc')
+    assert not tracemalloc.is_tracing()
+    assert handler.stop_profile(path) == []
+    # Tracing started before profiling keeps running
+    tracemalloc.start()
+    try:
+        handler.start_profile(memory=True)
+        handler.update(force=True, sync=True)
+        assert len(handler.stop_profile(path)) == 2
+        assert tracemalloc.is_tracing()
+    finally:
+        tracemalloc.stop()
+
+
+def test_profile_stop_during_update(tmp_path):
+    """Stopping while an update step is profiled doesn't wait for it, but
+    the update thread writes the profile once the step is done."""
+    # pylint: disable=protected-access
+    _, handler = make_handler(['import os', 'x = os.path'])
+    handler.start_profile()
+    update_step = handler._update_step
+    started = threading.Event()
+    resume = threading.Event()
+
+    def blocking_update_step(*args, **kwargs):
+        started.set()
+        resume.wait()
+        update_step(*args, **kwargs)
+
+    handler._update_step = blocking_update_step
+    handler.update(force=True)
+    started.wait()
+    path = str(tmp_path / 'profile')
+    assert handler.stop_profile(path) is None
+    resume.set()
+    handler._update_thread.join()
+    stats = pstats.Stats(path)
+    assert any(func[2] == 'blocking_update_step' for func in stats.stats)
+    assert handler.stop_profile(path) == []
+
+
+def test_memory_usage():
+    _, handler = make_handler(['a%d = len' % i for i in range(100)])
+    usage = handler.memory_usage()
+    assert usage['nodes'] < 100
+    symbols = usage['symbols']
+    handler.update(force=True, sync=True)
+    usage = handler.memory_usage()
+    assert usage['nodes'] > 200 * 50
+    # The symbols of the 100 names of the module
+    assert usage['symbols'] - symbols > 100 * 8
+    assert usage['total'] == sum(v for k, v in usage.items() if k != 'total')
+
+
+def test_evict():
+    vim, handler = make_handler(['a%d = len' % i for i in range(100)])
+    handler.viewport(1, 10)
+    handler.update(force=True, sync=True)
+    hls = vim.current.buffer.visible_highlights()
+    usage = handler.memory_usage()['total']
+    assert handler.evict()
+    assert not handler.evict()
+    assert handler.memory_usage()['total'] < usage / 2
+    # The highlights stay until the state is rebuilt
+    assert vim.current.buffer.visible_highlights() == hls
+    vim.current.buffer[0] = 'a0 = foo'
+    handler.update(sync=True)
+    hls = vim.current.buffer.visible_highlights()
+    assert (UNRESOLVED, 0, 5, 8) in hls
+    assert (BUILTIN, 0, 5, 8) not in hls
+    assert highlighted_lines(vim) == set(range(19))
+
+
+def test_evict_handlers():
+    vim = FakeNvim(variables={**VARIABLES, 'semshi#max_warm_handlers': 2})
+    plugin = Plugin(vim)
+    plugin._init_with_vim()  # pylint: disable=protected-access
+    bufs = [FakeBuffer(vim, i, ['x%d = %d' % (i, i)]) for i in range(1, 5)]
+
+    def enter(buf):
+        # pylint: disable=protected-access
+        plugin._select_handler(buf)
+        plugin._update_viewport(1, 10)
+        plugin._cur_handler.update(sync=True)
+
+    def warm():
+        # pylint: disable=protected-access
+        return [n for n, h in plugin._handlers.items() if h.warm]
+
+    for buf in bufs[:3]:
+        enter(buf)
+    assert warm() == [2, 3]
+    enter(bufs[1])
+    enter(bufs[3])
+    assert warm() == [2, 4]
+    # An evicted buffer is parsed again when it's entered
+    enter(bufs[2])
+    assert warm() == [4, 3]
+    assert bufs[2].visible_highlights()
+
+
+def test_cursor_moved():
+    """Of a burst of cursor moves, only the latest one is marked."""
+    vim = FakeNvim(['x = 1', 'y = x', 'z = y', 'x = z'],
+                   variables={
+                       **VARIABLES, 'semshi#cursor_delay': .05
+                   })
+    # pylint: disable=protected-access
+    plugin = Plugin(vim)
+    plugin._init_with_vim()
+    plugin._select_handler(vim.current.buffer)
+    handler = plugin._cur_handler
+    handler.update(sync=True)
+    cursors = []
+    mark_selected = handler.mark_selected
+    handler.mark_selected = lambda cursor: (cursors.append(cursor),
+                                            mark_selected(cursor))
+    for cursor in [(1, 0), (2, 0), (2, 4), (3, 0), (3, 4)]:
+        plugin.event_cursor_moved([1, 4, *cursor, 1000])
+    assert not cursors
+    time.sleep(.2)
+    assert cursors == [(3, 4)]
+    assert {n.name for n in handler._selected_nodes} == {'y'}
+
+
+def test_window_switches_buffer():
+    vim = FakeNvim(variables=VARIABLES)
+    # pylint: disable=protected-access
+    plugin = Plugin(vim)
+    plugin._init_with_vim()
+    bufs = [FakeBuffer(vim, i, ['x = %d' % i]) for i in range(1, 3)]
+    handlers = []
+    for buf in bufs:
+        plugin._select_handler(buf)
+        plugin._update_viewport(1, 10, 1000)
+        plugin._update_viewport(1, 10, 1001)
+        handlers.append(plugin._cur_handler)
+    assert not handlers[0]._views
+    assert set(handlers[1]._views) == {1000, 1001}
+    plugin.event_win_closed([1001])
+    assert set(handlers[1]._views) == {1000}
@@ -20,6 +20,7 @@ from semshi.node import (
     SELF,
     UNRESOLVED,
     Node,
+    Scope,
     group,
 )
 from semshi.parser import Parser, UnparsableError
@@ -758,6 +759,34 @@ def test_same_nodes_exclude_current():
     assert set(parser.same_nodes(a0, mark_original=False)) == {a1, a2}
 
 
+def test_same_nodes_sibling_scopes():
+    """Scopes sharing a line are told apart."""
+    parser = make_parser('f = lambda x: x + 1; g = lambda x: x * 2')
+    f, f_x, f_x2, g, g_x, g_x2 = parser._nodes
+    assert set(parser.same_nodes(f_x)) == {f_x, f_x2}
+    assert set(parser.same_nodes(g_x2)) == {g_x, g_x2}
+    if PEP_709:
+        return
+    parser = make_parser('[y for y in a] + [y for y in b]')
+    _, y1, y2, _, y3, y4 = parser._nodes
+    assert set(parser.same_nodes(y1)) == {y1, y2}
+    assert set(parser.same_nodes(y4)) == {y3, y4}
+
+
+def test_same_nodes_scope_moved():
+    """A scope whose opening line is edited stays the same scope when nodes in
+    its other lines are reused."""
+    code = dedent(r'''
+        foo(1, lambda x:
+            x)
+    ''')
+    parser = make_parser(code)
+    parser.parse(code.replace('foo(1', 'foo(12'))
+    assert parser.stats['reuse'] == 1
+    assert sorted(n.pos for n in parser.same_nodes((2, 15))) == \
+        [(2, 15), (3, 4)]
+
+
 def test_same_nodes_empty():
     parser = make_parser('0, 1')
     assert parser.same_nodes((1, 0)) == []
@@ -804,8 +833,9 @@ def test_refresh_names():
             z = y
         a, b
     '''))
-    assert len(add) == 5
-    assert len(clear) == 3
+    # Inserting a line only adds its names
+    assert len(add) == 2
+    assert len(clear) == 0
     add, clear = parser.parse(dedent(r'''
         def foo():
             z = y
@@ -823,6 +853,28 @@ def test_refresh_names():
     # yapf: enable
 
 
+def test_line_shift():
+    """Nodes after inserted or deleted lines keep their IDs."""
+    parser = Parser()
+    lines = ['a = 1', 'b = a', 'c = b']
+    nodes, _ = parser.parse('\n'.join(lines))
+    ids = [n.id for n in nodes]
+    add, rem = parser.parse('\n'.join(lines[:1] + ['x = a'] + lines[1:]))
+    assert parser.line_shift == (1, 1)
+    assert [(n.name, n.lineno) for n in add] == [('x', 2), ('a', 2)]
+    assert rem == []
+    assert [n.id for n in parser._nodes if n.lineno != 2] == ids
+    add, rem = parser.parse('\n'.join(lines))
+    assert parser.line_shift == (1, -1)
+    assert add == []
+    assert [(n.name, n.lineno) for n in rem] == [('x', 2), ('a', 2)]
+    assert [n.id for n in parser._nodes] == ids
+    # Changing a line besides inserting one requires a refresh
+    parser.parse('\n'.join(['y = 1', 'a = 2'] + lines[1:]))
+    assert parser.line_shift is None
+    assert parser.stats['refresh'] == 2
+
+
 def test_exclude_types():
     # yapf: disable
     parser = Parser(exclude=[LOCAL])
@@ -1155,10 +1207,14 @@ class TestNode:
                 return next(sym for sym in self.symbols if sym.name == name)
             def get_type(self):
                 return self.type
+            def get_name(self):
+                return 'top'
+            def get_lineno(self):
+                return 0
         # yapf: enable
 
-        a = Node('foo', 0, 0, [Table([Symbol('foo', local=True)])])
-        b = Node('bar', 0, 10, [Table([Symbol('bar', local=True)])])
+        a = Node('foo', 0, 0, Scope(Table([Symbol('foo', local=True)])))
+        b = Node('bar', 0, 10, Scope(Table([Symbol('bar', local=True)])))
         assert a.id + 1 == b.id
 
 
@@ -1172,6 +1228,100 @@ def test_diff():
     assert add0[0].id == rem[0].id
 
 
+def test_diff_keeps_visit_order():
+    """After a minor change, the nodes stay in the order they were visited and
+    unchanged nodes keep their IDs."""
+    parser = make_parser('def f(a=b): pass\nx')
+    ids = [n.id for n in parser._nodes[:3]]
+    add, rem = parser.parse('def f(a=b): pass\ny')
+    assert [n.name for n in add] == ['y']
+    assert [n.name for n in rem] == ['x']
+    assert [n.name for n in parser._nodes] == ['b', 'f', 'a', 'y']
+    assert [n.id for n in parser._nodes[:3]] == ids
+
+
+@pytest.mark.parametrize(
+    'code, variants',
+    [
+        # A new local shadows a global
+        (['x = 1', 'def f():', '    return x'], ['    pass', '    x = 2']),
+        # A parameter becomes used and unused again
+        (['def f(a, b):', '    pass'], ['    a', '    b', '    pass']),
+        # An import becomes an assignment
+        (['import x', 'x'], ['x = 1', 'import x']),
+        # Only expressions change
+        (['def f(a):', '    return a'], ['    return a + 1', '    return b']),
+    ])
+def test_minor_change_window(code, variants):
+    """Highlights updated with minor changes must always match the ones of a
+    full parse."""
+    parser = Parser()
+    highlights = {}
+
+    def apply(add, rem):
+        for node in rem:
+            del highlights[node.id]
+        for node in add:
+            highlights[node.id] = node._tup
+
+    apply(*parser.parse('\n'.join(code + ['pass'])))
+    for line in variants:
+        new_code = '\n'.join(code + [line])
+        apply(*parser.parse(new_code))
+        expected, _ = Parser().parse(new_code)
+        assert sorted(highlights.values()) == sorted(n._tup for n in expected)
+        assert {n.id for n in parser._nodes} == set(highlights)
+
+
+def test_minor_change_reuse():
+    """If no symbols changed, nodes outside of the changed line are reused."""
+    parser = make_parser(r'''
+        def f(a):
+            return a
+        x = f
+    ''')
+    old_nodes = parser._nodes[:]
+    code = dedent(r'''
+        def f(a):
+            return (a)
+        x = f
+    ''')
+    add, rem = parser.parse(code)
+    assert parser.stats['reuse'] == 1
+    assert [n.pos for n in add] == [(3, 12)]
+    assert [n.pos for n in rem] == [(3, 11)]
+    assert [n for n in parser._nodes if n.lineno != 3] == \
+        [n for n in old_nodes if n.lineno != 3]
+    assert all(
+        any(n is m for m in old_nodes) for n in parser._nodes if n.lineno != 3)
+    # A new symbol requires all nodes to be visited again
+    parser.parse(code.replace('return (a)', 'return (b)'))
+    assert parser.stats['reuse'] == 1
+    assert [n.hl_group for n in parser._nodes if n.name == 'a'] == \
+        [PARAMETER_UNUSED]
+
+
+def test_minor_change_reuse_order():
+    """Reused nodes are kept in visit order, so later changes can still be
+    diffed in the changed line window."""
+    code = dedent(r'''
+        import os
+        x = os
+        y = x + x
+        z = y
+    ''')
+    parser = make_parser(code)
+    code = code.replace('x = os', 'x = os + os + os')
+    parser.parse(code)
+    assert parser.stats['reuse'] == 1
+    expected = make_parser(code)
+    assert [n.pos for n in parser._nodes] == \
+        [n.pos for n in expected._nodes]
+    parser.parse(code.replace('z = y', 'w = y'))
+    assert parser.stats['window'] == 1
+    assert parser.stats['diff'] == 0
+
+
 def test_minor_change():
 
     def minor_change(c1, c2):
@@ -1188,3 +1338,81 @@ def test_specific_grammar(request):
         'data/grammar{0}{1}.py'.format(*sys.version_info[:2])
     with open(str(path), encoding='utf-8') as f:
         parse(f.read())
+
+
+def test_lazy_classification():
+    """Nodes outside of the view are classified when they are accessed."""
+    code = dedent(r'''
+        def f(a):
+            return a
+        x = f
+    ''')
+    parser = Parser()
+    add, _ = parser.parse(code, view=(2, 2))
+    assert [(n.name, n.lazy) for n in add] == \
+        [('f', False), ('a', False), ('a', False), ('x', True), ('f', True)]
+    # A node using a parameter is never lazy, so the parameter isn't unused
+    assert add[1].hl_group == PARAMETER
+    assert [n.hl_group for n in add[3:]] == [MODULE_FUNC, MODULE_FUNC]
+    assert not any(n.lazy for n in add)
+
+
+def test_release_symtables():
+    """Nodes don't need the symtables once they are classified, and are still
+    matched with the nodes of later parses."""
+    code = dedent(r'''
+        def f(a):
+            x = a
+            return x
+    ''')
+    parser = Parser()
+    add, _ = parser.parse(code, view=(2, 2))
+    # The lazy nodes still need the symtables
+    assert any(n.lazy for n in add)
+    assert parser.releasable_nodes() == []
+    assert [n.hl_group for n in add if n.lazy] == [LOCAL, LOCAL]
+    nodes = parser.releasable_nodes()
+    assert nodes == add
+    parser.release_symtables(nodes)
+    assert all(n.env.table is None for n in nodes)
+    assert parser.releasable_nodes() == []
+    parser.parse(code.replace('x = a', 'x = (a)'))
+    assert parser.stats['reuse'] == 1
+    same = sorted(n.pos for n in parser.same_nodes((4, 11)))
+    assert same == [(3, 4), (4, 11)]
+
+
+def test_visit_view(request):
+    """With a view, only the chunks of the module overlapping with the view are
+    visited by the parse, the others by visit_pending()."""
+    path = Path(request.fspath.dirname) / \
+        'data/grammar{0}{1}.py'.format(*sys.version_info[:2])
+    with open(str(path), encoding='utf-8') as f:
+        code = f.read()
+    expected, _ = Parser().parse(code)
+    view = (1000, 1040)
+    parser = Parser()
+    add, rem = parser.parse(code, view=view)
+    assert rem == []
+    assert len(add) < len(expected)
+    assert {n.lineno
+            for n in add} >= {
+                n.lineno
+                for n in expected if view[0] <= n.lineno <= view[1]
+            }
+    chunks = [add]
+    while True:
+        nodes = parser.visit_pending()
+        if nodes is None:
+            break
+        chunks.append(nodes)
+    assert len(chunks) > 2
+    assert sorted(n._tup for nodes in chunks for n in nodes) == \
+        sorted(n._tup for n in expected)
+    assert [n._tup for n in parser._nodes] == [n._tup for n in expected]
+    # A change before all chunks have been visited refreshes all nodes
+    parser = Parser()
+    parser.parse(code, view=view)
+    add, rem = parser.parse(code.replace('x', 'y', 1), view=view)
+    assert parser.stats['refresh'] == 2
+    assert parser._pending_chunks
@@ -0,0 +1,70 @@
+"""Unit Tests for semshi.util"""
+
+import json
+
+import pytest
+
+from semshi.util import Metrics, merge_ranges, metrics, timed
+
+
+@pytest.fixture
+def enabled_metrics():
+    metrics.clear()
+    metrics.enabled = True
+    yield metrics
+    metrics.enabled = False
+    metrics.clear()
+
+
+def test_timed(enabled_metrics):
+
+    @timed
+    def f(x):
+        return x
+
+    @timed('custom')
+    def g():
+        raise ValueError()
+
+    assert f(1) == 1
+    assert f(2) == 2
+    with pytest.raises(ValueError):
+        g()
+    summary = enabled_metrics.summary()
+    assert summary[f.__qualname__]['count'] == 2
+    assert summary['custom']['count'] == 1
+
+
+def test_timed_disabled():
+    metrics.clear()
+
+    @timed
+    def f():
+        pass
+
+    f()
+    assert metrics.summary() == {}
+
+
+def test_summary(tmp_path):
+    m = Metrics()
+    for i in range(1, 101):
+        m.add('label', i / 1000)
+    stats = m.summary()['label']
+    assert stats['count'] == 100
+    assert stats['total'] == pytest.approx(5.05)
+    assert stats['p50'] == .051
+    assert stats['p95'] == .095
+    assert stats['max'] == .1
+    path = tmp_path / 'stats.json'
+    m.dump(str(path))
+    assert json.loads(path.read_text()) == m.summary()
+    m.clear()
+    assert m.summary() == {}
+
+
+def test_merge_ranges():
+    assert merge_ranges([]) == []
+    assert merge_ranges([(10, 20), (1, 5), (15, 30), (6, 8), (40, 50)]) == \
+        [(1, 8), (10, 30), (40, 50)]
+    assert merge_ranges([(1, 10), (2, 3)]) == [(1, 10)]